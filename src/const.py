@@ -2,6 +2,7 @@ import cv2
 
 CONFIG_PATH = "/config/config.yaml"
 SECRETS_PATH = "/config/secrets.yaml"
+RECORDINGS_CATALOG_PATH = "/config/recordings.db"
 DEFAULT_CONFIG = """
 # See the README for the full list of configuration options.
 cameras:
@@ -58,6 +59,7 @@ CAMERA_SEGMENT_ARGS = [
     "copy",
     "-an",
 ]
+CAMERA_BUFFER_ARGS = ["-f", "mpegts", "-c", "copy", "-an"]
 
 ENCODER_CODEC = ""
 
@@ -78,6 +80,12 @@ HWACCEL_CUDA_ENCODER_CODEC = "h264_nvenc"
 HWACCEL_RPI3_DECODER_CODEC_MAP = {"h264": "h264_mmal"}
 HWACCEL_RPI3_ENCODER_CODEC = "h264_omx"
 
+# Padding added around objects sent to post processors, as a fraction of their size
+POST_PROCESSOR_CROP_PADDING = 0.1
+
+# Max width of the bitmap used to look up which zones an object is in
+ZONE_RASTER_WIDTH = 480
+
 RECORDER_GLOBAL_ARGS = ["-hide_banner"]
 RECORDER_HWACCEL_ARGS = []
 
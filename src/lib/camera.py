@@ -1,25 +1,84 @@
+import itertools
 import json
 import logging
+import math
 import os
 import subprocess as sp
-from threading import Event
+import time
+from threading import Event, Lock, Thread
 from time import sleep
 
 import cv2
 import numpy as np
 
-from const import CAMERA_SEGMENT_ARGS
-from lib.helpers import pop_if_full
+from const import CAMERA_BUFFER_ARGS, CAMERA_SEGMENT_ARGS
+from lib.frame_memory import (
+    SHED_MOTION_DETECTION,
+    SHED_OBJECT_DETECTION,
+    frame_memory,
+)
+from lib.jpeg import DEFAULT_QUALITY, encode_nv12
+from lib.packet_buffer import PacketBuffer
 from viseron_exceptions import FFprobeError
 
 LOGGER = logging.getLogger(__name__)
 
 
+class FrameCrop:
+    """RGB image of an area of a frame. Holds no reference to the frame it was cut
+    from, so the frame can be released as soon as the crop is made"""
+
+    def __init__(self, image, box, frame_width, frame_height):
+        self._image = image
+        self._box = box
+        self._frame_width = frame_width
+        self._frame_height = frame_height
+
+    @property
+    def image(self):
+        return self._image
+
+    @property
+    def box(self):
+        """Absolute x1, y1, x2, y2 of the crop inside the frame"""
+        return self._box
+
+    @property
+    def frame_width(self):
+        return self._frame_width
+
+    @property
+    def frame_height(self):
+        return self._frame_height
+
+
 class Frame:
-    def __init__(self, raw_frame, frame_width, frame_height):
+    """A single frame read from a camera.
+    Decoded, converted and resized representations are created on demand and
+    cached. They can all be recreated from the raw frame, so consumers release them
+    when they are done to keep the memory held by frames waiting in queues low.
+    Each consumer of the full size representations is registered with hold and
+    calls done when finished, and they are released when the last one is done.
+    The bytes held are reported to the process wide FrameMemory.
+    capture_time is the time.monotonic() timestamp of when the frame was read, and
+    sequence is increased by one for each frame read from the stream"""
+
+    def __init__(
+        self,
+        raw_frame,
+        frame_width,
+        frame_height,
+        camera_name=None,
+        capture_time=None,
+        sequence=None,
+    ):
         self._raw_frame = raw_frame
         self._frame_width = frame_width
         self._frame_height = frame_height
+        self._capture_time = (
+            capture_time if capture_time is not None else time.monotonic()
+        )
+        self._sequence = sequence
         self._decoded_frame = None
         self._decoded_frame_umat = None
         self._decoded_frame_umat_rgb = None
@@ -28,18 +87,62 @@ class Frame:
         self._objects = []
         self._motion_contours = None
 
+        self._camera_name = camera_name
+        self._sizes = {}  # Bytes held by each cached representation
+        self._users = 0  # Consumers of the full size representations
+        self._held = None
+        self._account_lock = Lock()
+        if camera_name:
+            self._memory = frame_memory()
+            self._held = self._memory.track(self, camera_name)
+            self.account("raw_frame", len(raw_frame))
+
+    def account(self, representation, nbytes):
+        """Reports the size of a cached representation, 0 when it is released"""
+        if self._held is None:
+            return
+        with self._account_lock:
+            change = nbytes - self._sizes.pop(representation, 0)
+            if nbytes:
+                self._sizes[representation] = nbytes
+            self._held[0] += change
+        self._memory.add(self._camera_name, change)
+
+    def hold(self, users=1):
+        """Registers consumers which will use the full size representations"""
+        with self._account_lock:
+            self._users += users
+
+    def done(self):
+        """Called by a consumer registered with hold when it is finished with the
+        full size representations. The last consumer releases them"""
+        with self._account_lock:
+            self._users = max(self._users - 1, 0)
+            last = not self._users
+        if last:
+            self.release_intermediates()
+
+    def release_intermediates(self):
+        """Releases the decoded and color converted full size representations"""
+        self._decoded_frame = None
+        self._decoded_frame_umat = None
+        self._decoded_frame_umat_rgb = None
+        self._decoded_frame_mat_rgb = None
+        for representation in (
+            "decoded_frame_umat",
+            "decoded_frame_umat_rgb",
+            "decoded_frame_mat_rgb",
+        ):
+            self.account(representation, 0)
+
+    def release_resized(self, decoder_name):
+        self._resized_frames.pop(decoder_name, None)
+        self.account(f"resized_{decoder_name}", 0)
+
     def decode_frame(self):
-        try:
-            self._decoded_frame = np.frombuffer(self.raw_frame, np.uint8).reshape(
-                int(self.frame_height * 1.5), self.frame_width
-            )
-        # except AttributeError:
-        # return False
-        # except IndexError:
-        # return False
-        except ValueError:
-            return False
-        return True
+        """Creates a view of the NV12 planes of the raw frame. No data is copied.
+        Returns False if the frame is incomplete"""
+        return self.decoded_frame is not None
 
     def resize(self, decoder_name, width, height):
         self._resized_frames[decoder_name] = cv2.resize(
@@ -47,14 +150,72 @@ class Frame:
             (width, height),
             interpolation=cv2.INTER_LINEAR,
         )
+        self.account(f"resized_{decoder_name}", width * height * 3)
 
     def get_resized_frame(self, decoder_name):
         return self._resized_frames.get(decoder_name)
 
+    def crop(self, box, padding=0.0):
+        """Returns a FrameCrop of a relative x1, y1, x2, y2 box, padded by a fraction
+        of the box size on each side. Only the cropped area is converted to RGB.
+        Returns None if the box is empty or the frame is corrupt"""
+        width, height = self.frame_width, self.frame_height
+        pad_x = (box[2] - box[0]) * padding
+        pad_y = (box[3] - box[1]) * padding
+        # Chroma is subsampled 2x2 in NV12, so the crop has to start and end on
+        # even coordinates
+        x1 = max(0, int((box[0] - pad_x) * width)) & ~1
+        y1 = max(0, int((box[1] - pad_y) * height)) & ~1
+        x2 = min(width, math.ceil((box[2] + pad_x) * width / 2) * 2)
+        y2 = min(height, math.ceil((box[3] + pad_y) * height / 2) * 2)
+        if x2 <= x1 or y2 <= y1:
+            return None
+
+        try:
+            planes = np.frombuffer(self.raw_frame, np.uint8).reshape(
+                int(height * 1.5), width
+            )
+        except ValueError:
+            return None
+        nv12_crop = np.concatenate(
+            (
+                planes[y1:y2, x1:x2],
+                planes[height + y1 // 2 : height + y2 // 2, x1:x2],
+            )
+        )
+        return FrameCrop(
+            cv2.cvtColor(nv12_crop, cv2.COLOR_YUV2RGB_NV21),
+            (x1, y1, x2, y2),
+            width,
+            height,
+        )
+
+    def jpeg(self, quality=DEFAULT_QUALITY):
+        """Returns the frame encoded as JPEG, straight from the raw frame"""
+        return encode_nv12(self.raw_frame, self.frame_width, self.frame_height, quality)
+
     @property
     def raw_frame(self):
         return self._raw_frame
 
+    @property
+    def capture_time(self):
+        return self._capture_time
+
+    @property
+    def sequence(self):
+        return self._sequence
+
+    @property
+    def age(self):
+        """Seconds since the frame was captured"""
+        return time.monotonic() - self._capture_time
+
+    def is_stale(self, max_age):
+        """Returns True if the frame is older than max_age seconds. A max_age of 0
+        never considers a frame stale"""
+        return bool(max_age) and self.age > max_age
+
     @property
     def frame_width(self):
         return self._frame_width
@@ -63,31 +224,53 @@ class Frame:
     def frame_height(self):
         return self._frame_height
 
+    # The representations are read into a local variable first, since they can be
+    # released by another consumer at any time
     @property
     def decoded_frame(self):
-        if self._decoded_frame is None:
-            self._decoded_frame = self.decode_frame()
-        return self._decoded_frame
+        decoded_frame = self._decoded_frame
+        if decoded_frame is None:
+            try:
+                decoded_frame = np.frombuffer(self.raw_frame, np.uint8).reshape(
+                    int(self.frame_height * 1.5), self.frame_width
+                )
+            except ValueError:
+                return None
+            self._decoded_frame = decoded_frame
+        return decoded_frame
 
     @property
     def decoded_frame_umat(self):
-        if self._decoded_frame_umat is None:
-            self._decoded_frame_umat = cv2.UMat(self.decoded_frame)
-        return self._decoded_frame_umat
+        decoded_frame_umat = self._decoded_frame_umat
+        if decoded_frame_umat is None:
+            decoded_frame_umat = cv2.UMat(self.decoded_frame)
+            self._decoded_frame_umat = decoded_frame_umat
+            self.account("decoded_frame_umat", len(self.raw_frame))
+        return decoded_frame_umat
 
     @property
     def decoded_frame_umat_rgb(self):
-        if self._decoded_frame_umat_rgb is None:
-            self._decoded_frame_umat_rgb = cv2.cvtColor(
+        decoded_frame_umat_rgb = self._decoded_frame_umat_rgb
+        if decoded_frame_umat_rgb is None:
+            decoded_frame_umat_rgb = cv2.cvtColor(
                 self.decoded_frame_umat, cv2.COLOR_YUV2RGB_NV21
             )
-        return self._decoded_frame_umat_rgb
+            self._decoded_frame_umat_rgb = decoded_frame_umat_rgb
+            self.account(
+                "decoded_frame_umat_rgb", self.frame_width * self.frame_height * 3
+            )
+        return decoded_frame_umat_rgb
 
     @property
     def decoded_frame_mat_rgb(self):
-        if self._decoded_frame_mat_rgb is None:
-            self._decoded_frame_mat_rgb = self.decoded_frame_umat_rgb.get()
-        return self._decoded_frame_mat_rgb
+        decoded_frame_mat_rgb = self._decoded_frame_mat_rgb
+        if decoded_frame_mat_rgb is None:
+            decoded_frame_mat_rgb = self.decoded_frame_umat_rgb.get()
+            self._decoded_frame_mat_rgb = decoded_frame_mat_rgb
+            self.account(
+                "decoded_frame_mat_rgb", self.frame_width * self.frame_height * 3
+            )
+        return decoded_frame_mat_rgb
 
     @property
     def objects(self):
@@ -108,15 +291,24 @@ class Frame:
 
 class Stream:
     def __init__(
-        self, logger, config, stream_config, write_segments=True, pipe_frames=True,
+        self,
+        logger,
+        config,
+        stream_config,
+        write_segments=True,
+        pipe_frames=True,
+        packet_buffer=None,
     ):
         self._logger = logger
         self._config = config
         self.stream_config = stream_config
         self._write_segments = write_segments
         self._pipe_frames = pipe_frames
+        self._packet_buffer = packet_buffer
 
         self._pipe = None
+        self._buffer_fd = None
+        self._sequence = itertools.count()
 
         stream_codec = None
         if (
@@ -226,7 +418,9 @@ class Stream:
 
     def build_command(self, ffmpeg_loglevel=None, single_frame=False):
         camera_segment_args = []
-        if not single_frame and self._write_segments:
+        if not single_frame and self._write_segments and self._packet_buffer:
+            camera_segment_args = CAMERA_BUFFER_ARGS + [f"pipe:{self._buffer_fd}"]
+        elif not single_frame and self._write_segments:
             camera_segment_args = CAMERA_SEGMENT_ARGS + [
                 os.path.join(
                     self._config.recorder.segments_folder,
@@ -257,9 +451,10 @@ class Stream:
                 stdout=sp.PIPE,
                 stderr=sp.PIPE,
             )
+        pass_fds = (self._buffer_fd,) if self._buffer_fd is not None else ()
         if self._pipe_frames:
-            return sp.Popen(self.build_command(), stdout=sp.PIPE)
-        return sp.Popen(self.build_command())
+            return sp.Popen(self.build_command(), stdout=sp.PIPE, pass_fds=pass_fds)
+        return sp.Popen(self.build_command(), pass_fds=pass_fds)
 
     def check_command(self):
         self._logger.debug("Performing a sanity check on the ffmpeg command")
@@ -283,15 +478,38 @@ class Stream:
             break
 
     def start_pipe(self):
+        buffer_read_fd = None
+        if self._packet_buffer and self._write_segments:
+            buffer_read_fd, self._buffer_fd = os.pipe()
+
         self._logger.debug(f"FFMPEG decoder command: {' '.join(self.build_command())}")
         self._pipe = self.pipe()
 
+        if buffer_read_fd is not None:
+            # The write end is now owned by ffmpeg. Closing it here makes the reader
+            # see EOF when ffmpeg exits
+            os.close(self._buffer_fd)
+            self._buffer_fd = None
+            buffer_thread = Thread(
+                target=self._packet_buffer.read_pipe, args=(buffer_read_fd,)
+            )
+            buffer_thread.daemon = True
+            buffer_thread.start()
+
     def close_pipe(self):
         self._pipe.terminate()
         self._pipe.communicate()
 
     def read(self):
-        return Frame(self._pipe.stdout.read(self._frame_bytes), self.width, self.height)
+        raw_frame = self._pipe.stdout.read(self._frame_bytes)
+        return Frame(
+            raw_frame,
+            self.width,
+            self.height,
+            camera_name=self._config.camera.name,
+            capture_time=time.monotonic(),
+            sequence=next(self._sequence),
+        )
 
 
 class FFMPEGCamera:
@@ -302,6 +520,8 @@ class FFMPEGCamera:
         self._connection_error = False
         self.resolution = None
         self._segments = None
+        self.packet_buffer = None
+        self._frame_memory = frame_memory()
         self.frame_ready = Event()
         self.scan_for_objects = Event()  # Set when frame should be scanned
         self.scan_for_motion = Event()  # Set when frame should be scanned
@@ -318,6 +538,13 @@ class FFMPEGCamera:
 
         self._logger.debug(f"Initializing camera {self._config.camera.name}")
 
+        if self._config.recorder.memory_buffer.enable:
+            self.packet_buffer = PacketBuffer(
+                self._logger,
+                self._config.recorder.lookback,
+                self._config.recorder.memory_buffer.max_size,
+            )
+
         if self._config.camera.substream:
             self.stream = Stream(
                 self._logger,
@@ -332,6 +559,7 @@ class FFMPEGCamera:
                 self._config.camera,
                 write_segments=True,
                 pipe_frames=False,
+                packet_buffer=self.packet_buffer,
             )
         else:
             self.stream = Stream(
@@ -340,6 +568,7 @@ class FFMPEGCamera:
                 self._config.camera,
                 write_segments=True,
                 pipe_frames=True,
+                packet_buffer=self.packet_buffer,
             )
 
         self.resolution = self.stream.width, self.stream.height
@@ -365,23 +594,17 @@ class FFMPEGCamera:
         if self._segments:
             self._segments.start_pipe()
 
-        object_frame_number = 0
+        # Frames are scanned based on their capture time, so the intervals are kept
+        # regardless of the frame rate of the stream
+        next_object_scan = 0.0
         object_first_scan = False
-        object_decoder_interval_calculated = round(
-            object_decoder_interval * self.stream.fps
-        )
         self._logger.debug(
-            f"Running object detection at {object_decoder_interval}s interval, "
-            f"every {object_decoder_interval_calculated} frame(s)"
+            f"Running object detection at {object_decoder_interval}s interval"
         )
 
-        motion_frame_number = 0
-        motion_decoder_interval_calculated = round(
-            motion_decoder_interval * self.stream.fps
-        )
+        next_motion_scan = 0.0
         self._logger.debug(
-            f"Running motion detection at {motion_decoder_interval}s interval, "
-            f"every {motion_decoder_interval_calculated} frame(s)"
+            f"Running motion detection at {motion_decoder_interval}s interval"
         )
 
         while self._connected:
@@ -395,48 +618,52 @@ class FFMPEGCamera:
 
             current_frame = self.stream.read()
             if self.scan_for_objects.is_set():
-                if object_frame_number % object_decoder_interval_calculated == 0:
+                if current_frame.capture_time >= next_object_scan and (
+                    not self._frame_memory.shed(
+                        SHED_OBJECT_DETECTION, "object detection", self._logger
+                    )
+                ):
                     if object_first_scan:
                         # force motion detection on same frame to save computing power
-                        motion_frame_number = 0
+                        next_motion_scan = 0.0
                         object_first_scan = False
-                    object_frame_number = 0
-                    pop_if_full(
-                        object_decoder_queue,
+                    next_object_scan = (
+                        current_frame.capture_time + object_decoder_interval
+                    )
+                    # Used by the decoder and then by the NVR
+                    current_frame.hold(2)
+                    object_decoder_queue.put(
                         {
                             "decoder_name": "object_detection",
                             "frame": current_frame,
                             "object_return_queue": object_return_queue,
                             "camera_config": self._config,
-                        },
-                        logger=self._logger,
-                        name="object_decoder_queue",
-                        warn=True,
+                        }
                     )
-
-                object_frame_number += 1
             else:
-                object_frame_number = 0
+                next_object_scan = 0.0
                 object_first_scan = True
 
             if self.scan_for_motion.is_set():
-                if motion_frame_number % motion_decoder_interval_calculated == 0:
-                    motion_frame_number = 0
-                    pop_if_full(
-                        motion_decoder_queue,
+                if current_frame.capture_time >= next_motion_scan and (
+                    not self._frame_memory.shed(
+                        SHED_MOTION_DETECTION, "motion detection", self._logger
+                    )
+                ):
+                    next_motion_scan = (
+                        current_frame.capture_time + motion_decoder_interval
+                    )
+                    # Used by the decoder and then by the NVR
+                    current_frame.hold(2)
+                    motion_decoder_queue.put(
                         {
                             "decoder_name": "motion_detection",
                             "frame": current_frame,
                             "motion_return_queue": motion_return_queue,
-                        },
-                        logger=self._logger,
-                        name="motion_decoder_queue",
-                        warn=True,
+                        }
                     )
-
-                motion_frame_number += 1
             else:
-                motion_frame_number = 0
+                next_motion_scan = 0.0
 
             self.frame_ready.set()
             self.frame_ready.clear()
@@ -451,15 +678,18 @@ class FFMPEGCamera:
         self._logger.debug("Starting decoder thread")
         while True:
             input_item = input_queue.get()
+            if input_item["frame"].is_stale(self._config.camera.max_frame_age):
+                self._logger.debug(
+                    f"Dropping frame {input_item['frame'].sequence} in "
+                    f"{input_item['decoder_name']} decoder, captured "
+                    f"{input_item['frame'].age:.2f}s ago"
+                )
+                continue
             if input_item["frame"].decode_frame():
                 input_item["frame"].resize(input_item["decoder_name"], width, height)
-                pop_if_full(
-                    output_queue,
-                    input_item,
-                    logger=self._logger,
-                    name=f"{input_item['decoder_name']} input",
-                    warn=True,
-                )
+                # Only the resized frame is needed by the detectors
+                input_item["frame"].done()
+                output_queue.put(input_item)
                 continue
 
             self._logger.error("Unable to decode frame. FFMPEG pipe seems broken")
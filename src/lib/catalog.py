@@ -0,0 +1,251 @@
+import json
+import logging
+import sqlite3
+import threading
+
+from const import RECORDINGS_CATALOG_PATH
+
+LOGGER = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS recordings (
+    id INTEGER PRIMARY KEY,
+    camera TEXT NOT NULL,
+    start_time REAL NOT NULL,
+    end_time REAL,
+    path TEXT NOT NULL UNIQUE,
+    size INTEGER,
+    thumbnail TEXT
+);
+CREATE INDEX IF NOT EXISTS recordings_camera_start_time
+    ON recordings (camera, start_time);
+CREATE TABLE IF NOT EXISTS recording_objects (
+    recording_id INTEGER NOT NULL REFERENCES recordings (id) ON DELETE CASCADE,
+    camera TEXT NOT NULL,
+    start_time REAL NOT NULL,
+    label TEXT NOT NULL,
+    max_confidence REAL NOT NULL,
+    zones TEXT NOT NULL,
+    PRIMARY KEY (recording_id, label)
+);
+CREATE INDEX IF NOT EXISTS recording_objects_camera_start_time_label
+    ON recording_objects (camera, start_time, label);
+CREATE TABLE IF NOT EXISTS metadata (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+
+class RecordingCatalog:
+    """Index of all recordings and the objects detected during them, stored in
+    SQLite. Each thread gets its own connection, and the database runs in WAL mode
+    so that lookups are not blocked by the recorders writing to it.
+    Errors are logged but never raised, a recording should not fail because the
+    catalog could not be updated"""
+
+    def __init__(self, path=RECORDINGS_CATALOG_PATH):
+        self._path = path
+        self._local = threading.local()
+        self.execute_script(SCHEMA)
+
+    @property
+    def connection(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self._path, timeout=30)
+            connection.row_factory = sqlite3.Row
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA foreign_keys=ON")
+            self._local.connection = connection
+        return connection
+
+    def execute_script(self, script):
+        try:
+            with self.connection as connection:
+                connection.executescript(script)
+        except sqlite3.Error as error:
+            LOGGER.error(f"Could not create recordings catalog: {error}")
+
+    def execute(self, query, parameters=()):
+        try:
+            with self.connection as connection:
+                return connection.execute(query, parameters)
+        except sqlite3.Error as error:
+            LOGGER.error(f"Recordings catalog error: {error}")
+            return None
+
+    def add_recording(self, camera, start_time, path, thumbnail=None):
+        """Adds a recording. Returns its id"""
+        cursor = self.execute(
+            "INSERT OR REPLACE INTO recordings (camera, start_time, path, thumbnail) "
+            "VALUES (?, ?, ?, ?)",
+            (camera, start_time, path, thumbnail),
+        )
+        return cursor.lastrowid if cursor else None
+
+    def import_recording(self, camera, start_time, path, size, thumbnail=None):
+        """Adds a finished recording unless it is already in the catalog"""
+        self.execute(
+            "INSERT OR IGNORE INTO recordings "
+            "(camera, start_time, end_time, path, size, thumbnail) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (camera, start_time, start_time, path, size, thumbnail),
+        )
+
+    def add_objects(self, recording_id, objects):
+        """Adds a summary of detected objects to a recording.
+        objects is a dict of label: (max confidence, zone names). Labels already
+        stored for the recording keep the highest confidence and all zones"""
+        if recording_id is None or not objects:
+            return
+
+        try:
+            with self.connection as connection:
+                recording = connection.execute(
+                    "SELECT camera, start_time FROM recordings WHERE id = ?",
+                    (recording_id,),
+                ).fetchone()
+                if recording is None:
+                    return
+
+                for label, (confidence, zones) in objects.items():
+                    stored = connection.execute(
+                        "SELECT max_confidence, zones FROM recording_objects "
+                        "WHERE recording_id = ? AND label = ?",
+                        (recording_id, label),
+                    ).fetchone()
+                    if stored:
+                        confidence = max(confidence, stored["max_confidence"])
+                        zones = set(zones) | set(json.loads(stored["zones"]))
+                    connection.execute(
+                        "INSERT OR REPLACE INTO recording_objects "
+                        "(recording_id, camera, start_time, label, max_confidence, "
+                        "zones) VALUES (?, ?, ?, ?, ?, ?)",
+                        (
+                            recording_id,
+                            recording["camera"],
+                            recording["start_time"],
+                            label,
+                            confidence,
+                            json.dumps(sorted(zones)),
+                        ),
+                    )
+        except sqlite3.Error as error:
+            LOGGER.error(f"Recordings catalog error: {error}")
+
+    def finish_recording(self, recording_id, end_time):
+        if recording_id is None:
+            return
+        self.execute(
+            "UPDATE recordings SET end_time = ? WHERE id = ?", (end_time, recording_id)
+        )
+
+    def update_thumbnail(self, recording_id, thumbnail):
+        if recording_id is None:
+            return
+        self.execute(
+            "UPDATE recordings SET thumbnail = ? WHERE id = ?",
+            (thumbnail, recording_id),
+        )
+
+    def update_size(self, path, size):
+        self.execute("UPDATE recordings SET size = ? WHERE path = ?", (size, path))
+
+    def delete_recording(self, recording_id):
+        """Returns False if the recording could not be deleted"""
+        cursor = self.execute("DELETE FROM recordings WHERE id = ?", (recording_id,))
+        return cursor is not None
+
+    def fetch(self, query, parameters=()):
+        cursor = self.execute(query, parameters)
+        return [dict(row) for row in cursor.fetchall()] if cursor else []
+
+    def files(self):
+        """Returns the paths of all recordings and thumbnails in the catalog"""
+        files = set()
+        for row in self.fetch("SELECT path, thumbnail FROM recordings"):
+            files.add(row["path"])
+            if row["thumbnail"]:
+                files.add(row["thumbnail"])
+        return files
+
+    def cameras(self):
+        rows = self.fetch("SELECT DISTINCT camera FROM recordings")
+        return [row["camera"] for row in rows]
+
+    def oldest_recordings(self, camera, before=None, limit=100):
+        """Returns the oldest finished recordings of a camera, optionally only the
+        ones that started before a timestamp"""
+        query = (
+            "SELECT id, path, size, thumbnail, start_time FROM recordings "
+            "WHERE camera = ? AND end_time IS NOT NULL"
+        )
+        parameters = [camera]
+        if before is not None:
+            query += " AND start_time < ?"
+            parameters.append(before)
+        query += " ORDER BY start_time LIMIT ?"
+        parameters.append(limit)
+        return self.fetch(query, parameters)
+
+    def total_size(self, camera):
+        rows = self.fetch(
+            "SELECT COALESCE(SUM(size), 0) AS size FROM recordings WHERE camera = ?",
+            (camera,),
+        )
+        return rows[0]["size"] if rows else 0
+
+    def get_metadata(self, key):
+        rows = self.fetch("SELECT value FROM metadata WHERE key = ?", (key,))
+        return rows[0]["value"] if rows else None
+
+    def set_metadata(self, key, value):
+        self.execute(
+            "INSERT OR REPLACE INTO metadata (key, value) VALUES (?, ?)", (key, value)
+        )
+
+    def query(self, camera=None, label=None, start_time=None, end_time=None):
+        """Returns the recordings matching all given arguments, oldest first.
+        Recordings are matched on their start time, which is between start_time and
+        end_time. Each recording is a dict, with the detected objects under
+        objects"""
+        conditions = []
+        parameters = []
+        if camera is not None:
+            conditions.append("camera = ?")
+            parameters.append(camera)
+        if start_time is not None:
+            conditions.append("start_time >= ?")
+            parameters.append(start_time)
+        if end_time is not None:
+            conditions.append("start_time <= ?")
+            parameters.append(end_time)
+        if label is not None:
+            # Uses the (camera, start_time, label) index of recording_objects
+            conditions.append(
+                "id IN (SELECT recording_id FROM recording_objects WHERE "
+                f"{' AND '.join(conditions + ['label = ?'])})"
+            )
+            parameters.extend(parameters + [label])
+
+        query = "SELECT * FROM recordings"
+        if conditions:
+            query += f" WHERE {' AND '.join(conditions)}"
+        query += " ORDER BY start_time"
+
+        recordings = self.fetch(query, parameters)
+        for recording in recordings:
+            recording["objects"] = [
+                {
+                    "label": row["label"],
+                    "max_confidence": row["max_confidence"],
+                    "zones": json.loads(row["zones"]),
+                }
+                for row in self.fetch(
+                    "SELECT label, max_confidence, zones FROM recording_objects "
+                    "WHERE recording_id = ?",
+                    (recording["id"],),
+                )
+            ]
+        return recordings
@@ -1,100 +1,411 @@
+import bisect
+import ctypes
+import ctypes.util
 import datetime
+import itertools
 import logging
+import math
 import os
+import select
+import struct
 import time
+from collections import deque
+from threading import Lock, Thread
+from typing import Deque, Dict, List, Tuple
 
 from apscheduler.schedulers.background import BackgroundScheduler
 from const import CAMERA_SEGMENT_DURATION
+from lib.catalog import RecordingCatalog
 from path import Path
 
 LOGGER = logging.getLogger(__name__)
 logging.getLogger("apscheduler.scheduler").setLevel(logging.ERROR)
 logging.getLogger("apscheduler.executors").setLevel(logging.ERROR)
 
+# Minutes between each run of the recordings cleanup
+CLEANUP_INTERVAL = 10
+# Hours between each scan of the recordings folder for files missing from the
+# catalog
+SCAN_INTERVAL = 6
+
 
 class Cleanup:
+    """Removes recordings according to the retention policy of each camera.
+    Recordings are looked up in the catalog, oldest first, so each run only touches
+    the recordings that are removed instead of scanning the recordings folder.
+    The folder is still scanned every SCAN_INTERVAL hours. Recordings missing from
+    the catalog are imported and then removed by the retention policy, and other
+    files left behind, like thumbnails and buffer files, are removed once they are
+    older than the retention period"""
+
     def __init__(self, config):
         self.directory = config.recorder.folder
+        self._recorder_config = config.recorder
+        self._cameras = [camera["name"] for camera in config.cameras]
+        self._catalog = RecordingCatalog()
+        self._lock = Lock()
+
+        self._scheduler = BackgroundScheduler(timezone="UTC")
+        self._scheduler.add_job(self.cleanup, "interval", minutes=CLEANUP_INTERVAL)
+        self._scheduler.add_job(self.scan_recordings, "interval", hours=SCAN_INTERVAL)
+
+    def import_recording(self, video):
+        """Adds a recording which is missing from the catalog. Returns False if the
+        file is not named like a recording"""
+        # Recordings are stored as <folder>/YYYY-MM-DD/<camera>/HH:MM:SS.mp4
+        try:
+            start_time = datetime.datetime.strptime(
+                f"{video.parent.parent.name} {video.stem}", "%Y-%m-%d %H:%M:%S"
+            ).timestamp()
+        except ValueError:
+            return False
+
+        # The recording is named after the start of the event, but the recorder
+        # stores the start of the lookback as the start time
+        thumbnail = f"{os.path.splitext(video)[0]}.jpg"
+        self._catalog.import_recording(
+            video.parent.name,
+            start_time - self._recorder_config.lookback,
+            str(video),
+            video.size,
+            thumbnail=thumbnail if os.path.isfile(thumbnail) else None,
+        )
+        return True
+
+    def remove_orphan(self, file):
+        """Removes a file which no recording refers to, once it is older than the
+        retention period of its camera. Returns True if it was removed"""
+        # Files are stored as <folder>/YYYY-MM-DD/<camera>/<file>
+        retain = self._recorder_config.retention(file.parent.name).retain
+        if time.time() - file.mtime < retain * 24 * 60 * 60:
+            return False
+        LOGGER.debug(f"Removing {file}, which belongs to no recording")
+        try:
+            os.remove(file)
+        except FileNotFoundError:
+            pass
+        except OSError as error:
+            LOGGER.error(f"Could not remove {file}: {error}")
+            return False
+        self.remove_empty_folders(os.path.dirname(file))
+        return True
+
+    def scan_recordings(self):
+        """Adds recordings which are not in the catalog, eg recordings made before
+        the catalog existed or whose catalog entry could not be written. Other files
+        which belong to no recording are removed when they expire"""
+        LOGGER.debug("Scanning the recordings folder for files missing from catalog")
+        known_files = self._catalog.files()
+        imported = 0
+        removed = 0
+        for file in Path(self.directory).walkfiles():
+            if str(file) in known_files or file.name == "latest_thumbnail.jpg":
+                continue
+            if file.ext == f".{self._recorder_config.extension}":
+                imported += self.import_recording(file)
+            else:
+                removed += self.remove_orphan(file)
+
+        if imported:
+            LOGGER.info(f"Imported {imported} recordings to the recordings catalog")
+        if removed:
+            LOGGER.info(f"Removed {removed} files which belong to no recording")
+
+    @staticmethod
+    def remove_empty_folders(folder):
+        """Removes the camera and date folders once they are empty"""
+        for _ in range(2):
+            try:
+                os.rmdir(folder)
+            except OSError:
+                break
+            LOGGER.debug(f"Removing directory {folder}")
+            folder = os.path.dirname(folder)
+
+    def remove_recording(self, recording):
+        """Removes a recording, its thumbnail and any buffer file left behind.
+        Returns False if it could not be removed from the catalog"""
+        LOGGER.debug(f"Removing recording {recording['path']}")
+        for file in (
+            recording["path"],
+            recording["thumbnail"],
+            f"{recording['path']}.ts",
+        ):
+            if not file:
+                continue
+            try:
+                os.remove(file)
+            except FileNotFoundError:
+                pass
+            except OSError as error:
+                LOGGER.error(f"Could not remove {file}: {error}")
+        if not self._catalog.delete_recording(recording["id"]):
+            return False
 
-        if config.recorder.retain is None:
-            self.days_to_retain = 7
-            LOGGER.error(
-                "Number of days to retain recordings is not specified. Defaulting to 7"
+        self.remove_empty_folders(os.path.dirname(recording["path"]))
+        return True
+
+    def remove_expired(self, camera, retain):
+        retention_period = time.time() - (retain * 24 * 60 * 60)
+        while True:
+            recordings = self._catalog.oldest_recordings(
+                camera, before=retention_period
             )
-        else:
-            self.days_to_retain = config.recorder.retain
+            if not recordings:
+                return
+            for recording in recordings:
+                if not self.remove_recording(recording):
+                    return
 
-        self._scheduler = BackgroundScheduler(timezone="UTC")
-        self._scheduler.add_job(self.cleanup, "cron", hour="1")
+    def enforce_max_size(self, camera, max_size):
+        total_size = self._catalog.total_size(camera)
+        while total_size > max_size:
+            recordings = self._catalog.oldest_recordings(camera)
+            if not recordings:
+                return
+            for recording in recordings:
+                if total_size <= max_size:
+                    return
+                if not self.remove_recording(recording):
+                    return
+                total_size -= recording["size"] or 0
 
     def cleanup(self):
-        LOGGER.debug("Running cleanup")
-        retention_period = time.time() - (self.days_to_retain * 24 * 60 * 60)
-        dirs = Path(self.directory)
-
-        extensions = ["*.mp4", "*.jpg"]
-        for extension in extensions:
-            files = dirs.walkfiles(extension)
-            for file in files:
-                if file.mtime <= retention_period:
-                    LOGGER.debug(f"Removing file {file}")
-                    file.remove()
-
-        folders = dirs.walkdirs("*-*-*")
-        for folder in folders:
-            LOGGER.debug(f"Items in {folder}: {len(folder.listdir())}")
-            for subdir in folder.listdir():
-                if os.path.isdir(subdir) and len(subdir.listdir()) == 0:
-                    try:
-                        os.rmdir(subdir)
-                        LOGGER.debug(f"Removing directory {subdir}")
-                    except OSError:
-                        LOGGER.error(f"Could not remove directory {subdir}")
-
-            if len(folder.listdir()) == 0:
-                try:
-                    folder.rmdir()
-                    LOGGER.debug(f"Removing directory {folder}")
-                except OSError:
-                    LOGGER.error(f"Could not remove directory {folder}")
+        with self._lock:
+            LOGGER.debug("Running cleanup")
+            for camera in set(self._cameras) | set(self._catalog.cameras()):
+                retention = self._recorder_config.retention(camera)
+                self.remove_expired(camera, retention.retain)
+                if retention.max_size is not None:
+                    self.enforce_max_size(camera, retention.max_size)
+
+    def initial_cleanup(self):
+        self.scan_recordings()
+        self.cleanup()
 
     def start(self):
         self._scheduler.start()
+        # Runs in the background so that startup is not blocked
+        self._scheduler.add_job(self.initial_cleanup)
+
+
+def segment_start_time(segment):
+    return datetime.datetime.strptime(segment.split(".")[0], "%Y%m%d%H%M%S").timestamp()
+
+
+class Inotify:
+    """Minimal inotify wrapper, reporting files that are closed after writing"""
+
+    IN_CLOSE_WRITE = 0x00000008
+    EVENT_HEADER = struct.Struct("iIII")
+
+    def __init__(self):
+        self._libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = self._libc.inotify_init1(os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self._watches: Dict[int, str] = {}
+
+    def add_watch(self, directory):
+        watch = self._libc.inotify_add_watch(
+            self.fd, os.fsencode(directory), self.IN_CLOSE_WRITE
+        )
+        if watch < 0:
+            raise OSError(ctypes.get_errno(), f"Could not watch {directory}")
+        self._watches[watch] = directory
+
+    def read(self):
+        """Returns a list of (directory, file name) for each closed file"""
+        data = os.read(self.fd, 64 * 1024)
+        events = []
+        offset = 0
+        while offset < len(data):
+            watch, _, _, length = self.EVENT_HEADER.unpack_from(data, offset)
+            offset += self.EVENT_HEADER.size
+            name = data[offset : offset + length].rstrip(b"\0").decode()
+            offset += length
+            if watch in self._watches and name:
+                events.append((self._watches[watch], name))
+        return events
+
+
+class SegmentManager:
+    """Keeps track of the segments of all cameras in a single thread.
+    Closed segments are reported by inotify and appended to a deque per camera,
+    which is sorted since segments are written in order. Expired segments are
+    popped from the left, so the segment folders never have to be listed again.
+    Falls back to listing the folders if inotify is not available"""
+
+    def __init__(self):
+        self._cameras: Dict[str, "SegmentCleanup"] = {}
+        self._lock = Lock()
+        try:
+            self._inotify = Inotify()
+        except (AttributeError, OSError) as error:
+            LOGGER.warning(f"inotify not available, polling segments: {error}")
+            self._inotify = None
+
+        manager_thread = Thread(target=self.run)
+        manager_thread.daemon = True
+        manager_thread.start()
+
+    def register(self, segment_cleanup):
+        """Starts tracking the segments of a camera. Segments left over from a
+        previous run are added to its deque.
+        The camera is registered before the folder is listed so that no segment
+        closed in between is missed. Segments seen twice are ignored"""
+        with self._lock:
+            self._cameras[segment_cleanup.directory] = segment_cleanup
+        if self._inotify:
+            self._inotify.add_watch(segment_cleanup.directory)
+        for segment in sorted(os.listdir(segment_cleanup.directory)):
+            segment_cleanup.add_segment(segment)
+
+    def poll(self):
+        """Adds new segments by listing the folders. The newest segment of each
+        camera is still being written and is skipped"""
+        with self._lock:
+            cameras = list(self._cameras.values())
+        for camera in cameras:
+            for segment in sorted(os.listdir(camera.directory))[:-1]:
+                camera.add_segment(segment)
+
+    def run(self):
+        while True:
+            if self._inotify:
+                readable, _, _ = select.select(
+                    [self._inotify.fd], [], [], CAMERA_SEGMENT_DURATION
+                )
+                if readable:
+                    for directory, segment in self._inotify.read():
+                        camera = self._cameras.get(directory)
+                        if camera:
+                            camera.add_segment(segment)
+            else:
+                time.sleep(CAMERA_SEGMENT_DURATION)
+                self.poll()
+
+            with self._lock:
+                cameras = list(self._cameras.values())
+            for camera in cameras:
+                camera.cleanup()
+
+
+_SEGMENT_MANAGER = None
+_SEGMENT_MANAGER_LOCK = Lock()
+
+
+def segment_manager():
+    """Returns the segment manager shared by all cameras"""
+    global _SEGMENT_MANAGER  # pylint: disable=global-statement
+    with _SEGMENT_MANAGER_LOCK:
+        if _SEGMENT_MANAGER is None:
+            _SEGMENT_MANAGER = SegmentManager()
+        return _SEGMENT_MANAGER
 
 
 class SegmentCleanup:
+    """Removes old segments. Segments needed by a recording are protected by pins.
+    A pin covers a time window, and a segment is kept as long as any pin overlaps
+    it, so cleanup never has to be paused.
+    The segments are tracked by the process wide SegmentManager"""
+
     def __init__(self, config):
         self._directory = os.path.join(
             config.recorder.segments_folder, config.camera.name
         )
         # Make sure we dont delete a segment which is needed by recorder
         self._max_age = config.recorder.lookback + (CAMERA_SEGMENT_DURATION * 3)
-        self._scheduler = BackgroundScheduler(timezone="UTC")
-        self._scheduler.add_job(
-            self.cleanup,
-            "interval",
-            seconds=CAMERA_SEGMENT_DURATION,
-            id="segment_cleanup",
-        )
-        self._scheduler.start()
+        self._pins: Dict[int, List] = {}
+        self._pin_ids = itertools.count()
+        self._pin_lock = Lock()
+        self._segments: Deque = deque()  # (start_time, segment), oldest first
+        # Expired segments which were pinned, only checked again when a pin changes
+        self._pinned: Dict[str, Tuple[float, float]] = {}  # segment: (start, end)
+        self._pins_changed = False
+        self._segments_lock = Lock()
+        segment_manager().register(self)
 
-    def cleanup(self):
-        now = datetime.datetime.now().timestamp()
-        for segment in os.listdir(self._directory):
-            start_time = datetime.datetime.strptime(
-                segment.split(".")[0], "%Y%m%d%H%M%S"
-            ).timestamp()
-            if now - start_time > self._max_age:
-                os.remove(os.path.join(self._directory, segment))
+    @property
+    def directory(self):
+        return self._directory
 
-    def start(self):
-        LOGGER.debug("Starting segment cleanup")
-        self._scheduler.start()
+    def add_segment(self, segment):
+        try:
+            start_time = segment_start_time(segment)
+        except ValueError:
+            return
+        with self._segments_lock:
+            # Segments are usually reported in order and appended. Segments found
+            # when listing the folder at startup can arrive late or twice
+            entry = (start_time, segment)
+            if segment in self._pinned:
+                return
+            if not self._segments or entry > self._segments[-1]:
+                self._segments.append(entry)
+                return
+            index = bisect.bisect_left(self._segments, entry)
+            if index < len(self._segments) and self._segments[index] == entry:
+                return
+            self._segments.insert(index, entry)
+
+    def pin(self, start, end=None):
+        """Protects segments between timestamps start and end from removal.
+        An end of None keeps all segments after start until the pin is updated.
+        Returns an id used to update or remove the pin"""
+        with self._pin_lock:
+            pin_id = next(self._pin_ids)
+            self._pins[pin_id] = [start, end]
+        LOGGER.debug(f"Pinning segments from {start} to {end}")
+        return pin_id
 
-    def pause(self):
-        LOGGER.debug("Pausing segment cleanup")
-        self._scheduler.pause_job("segment_cleanup")
+    def update_pin(self, pin_id, end):
+        with self._pin_lock:
+            self._pins[pin_id][1] = end
+            self._pins_changed = True
+
+    def unpin(self, pin_id):
+        with self._pin_lock:
+            self._pins.pop(pin_id, None)
+            self._pins_changed = True
+
+    def is_pinned(self, start_time, end_time):
+        with self._pin_lock:
+            return any(
+                start_time <= (pin_end if pin_end else math.inf)
+                and end_time >= pin_start
+                for pin_start, pin_end in self._pins.values()
+            )
+
+    def remove_segment(self, segment):
+        try:
+            os.remove(os.path.join(self._directory, segment))
+        except FileNotFoundError:
+            pass
+
+    def cleanup(self):
+        """Removes expired segments from the start of the deque. Expired segments
+        which are pinned are moved aside and only checked again when a pin changes.
+        Stops at the first segment which has not expired, since all later segments
+        are newer"""
+        now = datetime.datetime.now().timestamp()
+        with self._segments_lock:
+            with self._pin_lock:
+                pins_changed, self._pins_changed = self._pins_changed, False
+            if pins_changed:
+                for segment, (start_time, end_time) in list(self._pinned.items()):
+                    if not self.is_pinned(start_time, end_time):
+                        del self._pinned[segment]
+                        self.remove_segment(segment)
 
-    def resume(self):
-        LOGGER.debug("Resuming segment cleanup")
-        self._scheduler.resume_job("segment_cleanup")
+            while self._segments:
+                start_time, segment = self._segments[0]
+                if now - start_time <= self._max_age:
+                    break
+                self._segments.popleft()
+                # A segment ends where the next one starts
+                end_time = self._segments[0][0] if self._segments else now
+                if self.is_pinned(start_time, end_time):
+                    self._pinned[segment] = (start_time, end_time)
+                    continue
+                self.remove_segment(segment)
@@ -93,6 +93,7 @@ VISERON_CONFIG_SCHEMA = Schema(
         Optional("recorder", default={}): RecorderConfig.schema,
         Optional("mqtt", default=None): Any(MQTTConfig.schema, None),
         Optional("logging", default={}): LoggingConfig.schema,
+        Optional("frame_memory_budget", default=1024): All(int, Range(min=0)),
     }
 )
 
@@ -145,11 +146,16 @@ class ViseronConfig(BaseConfig):
         self._recorder = RecorderConfig(config["recorder"])
         self._mqtt = MQTTConfig(config["mqtt"]) if config.get("mqtt", None) else None
         self._logging = LoggingConfig(config["logging"])
+        self._frame_memory_budget = config["frame_memory_budget"] * 1024 * 1024
 
     @property
     def cameras(self):
         return self._cameras
 
+    @property
+    def frame_memory_budget(self):
+        return self._frame_memory_budget
+
 
 class NVRConfig(BaseConfig):
     def __init__(
@@ -56,6 +56,13 @@ def ensure_mqtt_name(camera: Dict[str, str]) -> Dict[str, str]:
     return camera
 
 
+def ensure_publish_image(publish_image):
+    """Allows publish_image to be set to a bool as well as a dictionary"""
+    if isinstance(publish_image, bool):
+        return PUBLISH_IMAGE_SCHEMA({"enable": publish_image})
+    return publish_image
+
+
 def check_for_hwaccels(hwaccel_args: List[str]) -> List[str]:
     if hwaccel_args:
         return hwaccel_args
@@ -81,6 +88,19 @@ STREAM_SCEHMA = Schema(
     }
 )
 
+PUBLISH_IMAGE_SCHEMA = Schema(
+    {
+        Optional("enable", default=True): bool,
+        Optional("interval", default=0.0): All(
+            Any(float, int), Coerce(float), Range(min=0.0)
+        ),
+        Optional("width", default=None): Any(All(int, Range(min=1)), None),
+        Optional("height", default=None): Any(All(int, Range(min=1)), None),
+        Optional("quality", default=75): All(int, Range(min=1, max=100)),
+        Optional("skip_unchanged", default=False): bool,
+    }
+)
+
 CAMERA_SCHEMA = STREAM_SCEHMA.extend(
     {
         Required("name"): All(str, Length(min=1)),
@@ -121,17 +141,25 @@ CAMERA_SCHEMA = STREAM_SCEHMA.extend(
                 Optional("labels"): LABELS_SCHEMA,
                 Optional("logging"): LOGGING_SCHEMA,
                 Optional("log_all_objects"): bool,
+                Optional("post_processor_interval"): All(
+                    Any(float, int), Coerce(float), Range(min=0.0)
+                ),
             },
             None,
         ),
-        Optional("zones", default=[]): [
-            {
-                Required("name"): str,
-                Required("points"): [{Required("x"): int, Required("y"): int,}],
-                Optional("labels"): LABELS_SCHEMA,
-            }
-        ],
-        Optional("publish_image", default=False): Any(True, False),
+        Optional("zones", default=[]): All(
+            [
+                {
+                    Required("name"): str,
+                    Required("points"): [{Required("x"): int, Required("y"): int,}],
+                    Optional("labels"): LABELS_SCHEMA,
+                }
+            ],
+            Length(max=64),
+        ),
+        Optional("publish_image", default=False): All(
+            Any(bool, PUBLISH_IMAGE_SCHEMA), ensure_publish_image
+        ),
         Optional("ffmpeg_loglevel", default="fatal"): Any(
             "quiet",
             "panic",
@@ -144,6 +172,9 @@ CAMERA_SCHEMA = STREAM_SCEHMA.extend(
             "trace",
         ),
         Optional("ffmpeg_recoverable_errors", default=FFMPEG_RECOVERABLE_ERRORS): [str],
+        Optional("max_frame_age", default=0.0): All(
+            Any(float, int), Coerce(float), Range(min=0.0)
+        ),
         Optional("logging"): LOGGING_SCHEMA,
     },
 )
@@ -258,6 +289,40 @@ class Substream(Stream):
         self._rtsp_transport = camera["substream"]["rtsp_transport"]
 
 
+class PublishImage:
+    def __init__(self, publish_image):
+        self._enable = publish_image["enable"]
+        self._interval = publish_image["interval"]
+        self._width = publish_image["width"]
+        self._height = publish_image["height"]
+        self._quality = publish_image["quality"]
+        self._skip_unchanged = publish_image["skip_unchanged"]
+
+    @property
+    def enable(self):
+        return self._enable
+
+    @property
+    def interval(self):
+        return self._interval
+
+    @property
+    def width(self):
+        return self._width
+
+    @property
+    def height(self):
+        return self._height
+
+    @property
+    def quality(self):
+        return self._quality
+
+    @property
+    def skip_unchanged(self):
+        return self._skip_unchanged
+
+
 class CameraConfig(Stream):
     schema = SCHEMA
 
@@ -274,9 +339,10 @@ class CameraConfig(Stream):
         self._motion_detection = camera.get("motion_detection", {})
         self._object_detection = camera.get("object_detection", {})
         self._zones = self.generate_zones(camera["zones"])
-        self._publish_image = camera["publish_image"]
+        self._publish_image = PublishImage(camera["publish_image"])
         self._ffmpeg_loglevel = camera["ffmpeg_loglevel"]
         self._ffmpeg_recoverable_errors = camera["ffmpeg_recoverable_errors"]
+        self._max_frame_age = camera["max_frame_age"]
         self._logging = None
         if camera.get("logging", None):
             self._logging = LoggingConfig(camera["logging"])
@@ -355,6 +421,10 @@ class CameraConfig(Stream):
     def ffmpeg_recoverable_errors(self):
         return self._ffmpeg_recoverable_errors
 
+    @property
+    def max_frame_age(self):
+        return self._max_frame_age
+
     @property
     def logging(self):
         return self._logging
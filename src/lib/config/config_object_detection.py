@@ -86,6 +86,9 @@ SCHEMA = Schema(
         ),
         Optional("labels", default=[{"label": "person"}]): LABELS_SCHEMA,
         Optional("log_all_objects", default=False): bool,
+        Optional("post_processor_interval", default=0.0): All(
+            Any(float, int), Coerce(float), Range(min=0.0)
+        ),
         Optional("logging"): LOGGING_SCHEMA,
     },
     extra=ALLOW_EXTRA,
@@ -152,6 +155,10 @@ class ObjectDetectionConfig:
             "log_all_objects", object_detection["log_all_objects"]
         )
 
+        self._post_processor_interval = camera_object_detection.get(
+            "post_processor_interval", object_detection["post_processor_interval"]
+        )
+
         logging = camera_object_detection.get(
             "logging", (object_detection.get("logging", None)),
         )
@@ -189,6 +196,10 @@ class ObjectDetectionConfig:
     def log_all_objects(self):
         return self._log_all_objects
 
+    @property
+    def post_processor_interval(self):
+        return self._post_processor_interval
+
     @property
     def logging(self):
         return self._logging
@@ -1,4 +1,4 @@
-from voluptuous import All, Optional, Range, Schema
+from voluptuous import All, Any, Coerce, Optional, Range, Schema
 
 from .config_logging import LoggingConfig, SCHEMA as LOGGING_SCHEMA
 
@@ -8,16 +8,33 @@ SCHEMA = Schema(
         Optional("lookback", default=5): All(int, Range(min=0)),
         Optional("timeout", default=10): All(int, Range(min=0)),
         Optional("retain", default=7): All(int, Range(min=1)),
+        Optional("max_size", default=None): Any(
+            None, All(Coerce(float), Range(min=0))
+        ),
+        Optional("camera_retention", default={}): {
+            str: {
+                Optional("retain"): All(int, Range(min=1)),
+                Optional("max_size"): Any(None, All(Coerce(float), Range(min=0))),
+            }
+        },
         Optional("folder", default="/recordings"): str,
         Optional("extension", default="mp4"): str,
         Optional("hwaccel_args", default=[]): [str],
         Optional("codec", default="copy"): str,
         Optional("filter_args", default=[]): [str],
+        Optional("smart_cut", default=False): bool,
         Optional("segments_folder", default="/segments"): str,
+        Optional("incremental", default=False): bool,
+        Optional("merge_gap", default=0): All(int, Range(min=0)),
+        Optional("max_concurrent_jobs", default=2): All(int, Range(min=1)),
         Optional("thumbnail", default={}): {
             Optional("save_to_disk", default=False): bool,
             Optional("send_to_mqtt", default=False): bool,
         },
+        Optional("memory_buffer", default={}): {
+            Optional("enable", default=False): bool,
+            Optional("max_size", default=64): All(int, Range(min=1)),
+        },
         Optional("logging"): LOGGING_SCHEMA,
     }
 )
@@ -37,6 +54,39 @@ class Thumbnail:
         return self._send_to_mqtt
 
 
+class Retention:
+    def __init__(self, retain, max_size):
+        self._retain = retain
+        self._max_size = max_size
+
+    @property
+    def retain(self):
+        """Number of days to keep recordings"""
+        return self._retain
+
+    @property
+    def max_size(self):
+        """Max size of all recordings in bytes, or None if there is no limit"""
+        if self._max_size is None:
+            return None
+        return int(self._max_size * 1024 * 1024 * 1024)
+
+
+class MemoryBuffer:
+    def __init__(self, memory_buffer):
+        self._enable = memory_buffer["enable"]
+        self._max_size = memory_buffer["max_size"]
+
+    @property
+    def enable(self):
+        return self._enable
+
+    @property
+    def max_size(self):
+        """Max size of the buffer in bytes"""
+        return self._max_size * 1024 * 1024
+
+
 class RecorderConfig:
     schema = SCHEMA
 
@@ -44,13 +94,20 @@ class RecorderConfig:
         self._lookback = recorder["lookback"]
         self._timeout = recorder["timeout"]
         self._retain = recorder["retain"]
+        self._max_size = recorder["max_size"]
+        self._camera_retention = recorder["camera_retention"]
         self._folder = recorder["folder"]
         self._extension = recorder["extension"]
         self._hwaccel_args = recorder["hwaccel_args"]
         self._codec = recorder["codec"]
         self._filter_args = recorder["filter_args"]
+        self._smart_cut = recorder["smart_cut"]
         self._segments_folder = recorder["segments_folder"]
+        self._incremental = recorder["incremental"]
+        self._merge_gap = recorder["merge_gap"]
+        self._max_concurrent_jobs = recorder["max_concurrent_jobs"]
         self._thumbnail = Thumbnail(recorder["thumbnail"])
+        self._memory_buffer = MemoryBuffer(recorder["memory_buffer"])
         self._logging = None
         if recorder.get("logging", None):
             self._logging = LoggingConfig(recorder["logging"])
@@ -67,6 +124,18 @@ class RecorderConfig:
     def retain(self):
         return self._retain
 
+    @property
+    def max_size(self):
+        return self._max_size
+
+    def retention(self, camera_name):
+        """Returns the retention policy for a camera"""
+        camera_retention = self._camera_retention.get(camera_name, {})
+        return Retention(
+            camera_retention.get("retain", self._retain),
+            camera_retention.get("max_size", self._max_size),
+        )
+
     @property
     def folder(self):
         return self._folder
@@ -87,14 +156,37 @@ class RecorderConfig:
     def filter_args(self):
         return self._filter_args
 
+    @property
+    def smart_cut(self):
+        """Smart cut only applies when re-encoding without filters, since the stream
+        copied parts has to match the re-encoded parts. The re-encoded parts use the
+        format of the camera stream, not codec"""
+        return self._smart_cut and self._codec != "copy" and not self._filter_args
+
     @property
     def segments_folder(self):
         return self._segments_folder
 
+    @property
+    def incremental(self):
+        return self._incremental
+
+    @property
+    def merge_gap(self):
+        return self._merge_gap
+
+    @property
+    def max_concurrent_jobs(self):
+        return self._max_concurrent_jobs
+
     @property
     def thumbnail(self):
         return self._thumbnail
 
+    @property
+    def memory_buffer(self):
+        return self._memory_buffer
+
     @property
     def logging(self):
         return self._logging
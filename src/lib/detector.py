@@ -3,11 +3,11 @@ import logging
 from threading import Lock
 
 import cv2
+import numpy as np
 from voluptuous import Any, Optional, Required
 
 from lib.config.config_logging import LoggingConfig
 from lib.config.config_object_detection import SCHEMA as BASE_SCEHMA
-from lib.helpers import calculate_relative_coords, pop_if_full
 
 LOGGER = logging.getLogger(__name__)
 
@@ -21,62 +21,47 @@ SCHEMA = BASE_SCEHMA.extend(
 
 
 class DetectedObject:
-    """Object that holds a detected object. All coordinates and metrics are relative
-    to make it easier to do calculations on different image resolutions"""
-
-    def __init__(
-        self, label, confidence, x1, y1, x2, y2, relative=True, model_res=None
-    ):
-        self._label = label
-        self._confidence = round(float(confidence), 3)
-        if relative:
-            self._rel_x1 = float(round(x1, 3))
-            self._rel_y1 = float(round(y1, 3))
-            self._rel_x2 = float(round(x2, 3))
-            self._rel_y2 = float(round(y2, 3))
-        else:
-            (
-                self._rel_x1,
-                self._rel_y1,
-                self._rel_x2,
-                self._rel_y2,
-            ) = calculate_relative_coords((x1, y1, x2, y2), model_res)
-
-        self._rel_width = float(round(self._rel_x2 - self._rel_x1, 3))
-        self._rel_height = float(round(self._rel_y2 - self._rel_y1, 3))
-        self._relevant = False
+    """Light view of a single object inside a Detections instance. All coordinates
+    and metrics are relative to make it easier to do calculations on different
+    image resolutions"""
+
+    __slots__ = ("_detections", "_index")
+
+    def __init__(self, detections, index):
+        self._detections = detections
+        self._index = index
 
     @property
     def label(self):
-        return self._label
+        return str(self._detections.labels[self._index])
 
     @property
     def confidence(self):
-        return self._confidence
+        return float(self._detections.confidences[self._index])
 
     @property
     def rel_width(self):
-        return self._rel_width
+        return float(self._detections.widths[self._index])
 
     @property
     def rel_height(self):
-        return self._rel_height
+        return float(self._detections.heights[self._index])
 
     @property
     def rel_x1(self):
-        return self._rel_x1
+        return float(self._detections.boxes[self._index][0])
 
     @property
     def rel_y1(self):
-        return self._rel_y1
+        return float(self._detections.boxes[self._index][1])
 
     @property
     def rel_x2(self):
-        return self._rel_x2
+        return float(self._detections.boxes[self._index][2])
 
     @property
     def rel_y2(self):
-        return self._rel_y2
+        return float(self._detections.boxes[self._index][3])
 
     @property
     def formatted(self):
@@ -94,11 +79,100 @@ class DetectedObject:
     @property
     def relevant(self):
         """Returns if object is relevant, which means it passed through all filters"""
-        return self._relevant
+        return bool(self._detections.relevant[self._index])
 
     @relevant.setter
     def relevant(self, value):
-        self._relevant = value
+        self._detections.relevant[self._index] = value
+
+    @property
+    def snapshot_score(self):
+        """Returns the snapshot score of the object, or None if it is not scored"""
+        score = self._detections.snapshot_scores[self._index]
+        return None if np.isnan(score) else float(score)
+
+    @snapshot_score.setter
+    def snapshot_score(self, value):
+        self._detections.snapshot_scores[self._index] = value
+
+
+class Detections:
+    """Holds all objects detected in a frame as a struct of arrays.
+    Coordinates are relative, stored as x1, y1, x2, y2 in boxes.
+    Iterating yields DetectedObject views which are only created on demand"""
+
+    __slots__ = (
+        "_labels",
+        "_confidences",
+        "_boxes",
+        "_widths",
+        "_heights",
+        "_relevant",
+        "_snapshot_scores",
+        "_objects",
+    )
+
+    def __init__(self, labels, confidences, boxes):
+        self._labels = np.asarray(labels, dtype=str).reshape(-1)
+        self._confidences = np.round(
+            np.asarray(confidences, dtype=np.float64).reshape(-1), 3
+        )
+        self._boxes = np.round(np.asarray(boxes, dtype=np.float64).reshape(-1, 4), 3)
+        self._widths = np.round(self._boxes[:, 2] - self._boxes[:, 0], 3)
+        self._heights = np.round(self._boxes[:, 3] - self._boxes[:, 1], 3)
+        self._relevant = np.zeros(len(self._labels), dtype=bool)
+        self._snapshot_scores = np.full(len(self._labels), np.nan)
+        self._objects = [None] * len(self._labels)
+
+    @classmethod
+    def from_absolute(cls, labels, confidences, boxes, model_res):
+        """Creates Detections from x1, y1, x2, y2 boxes in model coordinates"""
+        boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+        return cls(labels, confidences, np.divide(boxes, model_res * 2))
+
+    def __len__(self):
+        return len(self._labels)
+
+    def __getitem__(self, index):
+        if self._objects[index] is None:
+            self._objects[index] = DetectedObject(self, index)
+        return self._objects[index]
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    def select(self, mask):
+        """Returns a list of DetectedObject views where mask is True"""
+        return [self[index] for index in np.flatnonzero(mask)]
+
+    @property
+    def labels(self):
+        return self._labels
+
+    @property
+    def confidences(self):
+        return self._confidences
+
+    @property
+    def boxes(self):
+        return self._boxes
+
+    @property
+    def widths(self):
+        return self._widths
+
+    @property
+    def heights(self):
+        return self._heights
+
+    @property
+    def relevant(self):
+        return self._relevant
+
+    @property
+    def snapshot_scores(self):
+        return self._snapshot_scores
 
 
 class Detector:
@@ -126,12 +200,19 @@ class Detector:
     def object_detection(self, detector_queue):
         while True:
             frame = detector_queue.get()
+            camera_config = frame["camera_config"]
+            if frame["frame"].is_stale(camera_config.camera.max_frame_age):
+                LOGGER.debug(
+                    f"Dropping frame {frame['frame'].sequence} from "
+                    f"{camera_config.camera.name}, captured "
+                    f"{frame['frame'].age:.2f}s ago"
+                )
+                continue
             self.detection_lock.acquire()
             frame["frame"].objects = self.object_detector.return_objects(frame)
             self.detection_lock.release()
-            pop_if_full(
-                frame["object_return_queue"], frame,
-            )
+            frame["frame"].release_resized(frame["decoder_name"])
+            frame["object_return_queue"].put(frame)
 
     @property
     def model_width(self):
@@ -3,6 +3,7 @@ import logging
 import os
 
 import cv2
+import numpy as np
 from cv2.dnn import (
     DNN_BACKEND_CUDA,
     DNN_BACKEND_DEFAULT,
@@ -68,7 +69,9 @@ class ObjectDetection:
         self.labels = None
         if labels:
             with open(labels, "rt") as labels_file:
-                self.labels = labels_file.read().rstrip("\n").split("\n")
+                self.labels = np.array(
+                    labels_file.read().rstrip("\n").split("\n"), dtype=str
+                )
 
     def load_network(self, model, model_config, backend, target):
         # Load a network
@@ -77,22 +80,14 @@ class ObjectDetection:
         self.net.setPreferableTarget(target)
 
     def post_process(self, labels, confidences, boxes):
-        detections = []
-        for (label, confidence, box) in zip(labels, confidences, boxes):
-            detections.append(
-                detector.DetectedObject(
-                    self.labels[int(label[0])],
-                    confidence[0],
-                    box[0],
-                    box[1],
-                    box[0] + box[2],
-                    box[1] + box[3],
-                    relative=False,
-                    model_res=self.model_res,
-                )
-            )
-
-        return detections
+        boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+        boxes[:, 2:] += boxes[:, :2]  # x, y, w, h -> x1, y1, x2, y2
+        return detector.Detections.from_absolute(
+            self.labels[np.asarray(labels, dtype=int).reshape(-1)],
+            confidences,
+            boxes,
+            self.model_res,
+        )
 
     def return_objects(self, frame):
         labels, confidences, boxes = self.model.detect(
@@ -56,14 +56,20 @@ class ObjectDetection:
             self._model_width = self.tensor_input_details[0]["shape"][1]
             self._model_height = self.tensor_input_details[0]["shape"][2]
 
-    def read_labels(self, file_path):
+    @staticmethod
+    def read_labels(file_path):
+        """Returns an array of labels indexed by label id"""
         with open(file_path, "r") as label_file:
             lines = label_file.readlines()
         labels = {}
         for line in lines:
             pair = line.strip().split(maxsplit=1)
             labels[int(pair[0])] = pair[1].strip()
-        return labels
+
+        label_array = np.full(max(labels) + 1, "", dtype=object)
+        for label_id, label in labels.items():
+            label_array[label_id] = label
+        return label_array.astype(str)
 
     def pre_process(self, frame):
         # This should be moved to decoder for speed
@@ -78,26 +84,17 @@ class ObjectDetection:
         return np.squeeze(tensor)
 
     def post_process(self, confidence):
-        processed_objects = []
-        boxes = self.output_tensor(0)
-        labels = self.output_tensor(1)
-        scores = self.output_tensor(2)
         count = int(self.output_tensor(3))
-
-        for i in range(count):
-            if float(scores[i]) > confidence:
-                processed_objects.append(
-                    detector.DetectedObject(
-                        self.labels[int(labels[i])],
-                        float(scores[i]),
-                        boxes[i][1],
-                        boxes[i][0],
-                        boxes[i][3],
-                        boxes[i][2],
-                    )
-                )
-
-        return processed_objects
+        boxes = self.output_tensor(0)[:count]
+        labels = self.output_tensor(1)[:count]
+        scores = self.output_tensor(2)[:count]
+
+        keep = scores > confidence
+        return detector.Detections(
+            self.labels[labels[keep].astype(int)],
+            scores[keep],
+            boxes[keep][:, [1, 0, 3, 2]],  # y1, x1, y2, x2 -> x1, y1, x2, y2
+        )
 
     def return_objects(self, frame):
         tensor = self.pre_process(
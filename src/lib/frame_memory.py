@@ -0,0 +1,85 @@
+import logging
+import weakref
+from threading import Lock
+
+LOGGER = logging.getLogger(__name__)
+
+# Work is shed when the memory held by frames exceeds this fraction of the budget.
+# Lower values are shed first
+SHED_PUBLISH_IMAGE = 0.7
+SHED_MOTION_DETECTION = 0.85
+SHED_OBJECT_DETECTION = 1.0
+
+_FRAME_MEMORY = None
+_FRAME_MEMORY_LOCK = Lock()
+
+
+def frame_memory(budget=None):
+    """Returns the frame memory accounting shared by all cameras.
+    The budget is set by the first caller which supplies one"""
+    global _FRAME_MEMORY  # pylint: disable=global-statement
+    with _FRAME_MEMORY_LOCK:
+        if _FRAME_MEMORY is None:
+            _FRAME_MEMORY = FrameMemory(budget)
+        elif budget is not None and _FRAME_MEMORY.budget is None:
+            _FRAME_MEMORY.budget = budget
+        return _FRAME_MEMORY
+
+
+def _release_frame(memory, camera, held):
+    memory.add(camera, -held[0])
+
+
+class FrameMemory:
+    """Keeps track of the bytes held by live frames, per camera.
+    Each frame reports the representations it caches and releases, and whatever it
+    holds when it is garbage collected. When the total exceeds the budget, work is
+    shed in order of priority, see the SHED_* constants"""
+
+    def __init__(self, budget=None):
+        self.budget = budget
+        self._usage: dict = {}
+        self._total = 0
+        self._shedding: set = set()
+        self._lock = Lock()
+
+    def track(self, frame, camera):
+        """Starts accounting for a frame. Returns a list holding the number of bytes
+        the frame holds, which the frame updates through add"""
+        held = [0]
+        weakref.finalize(frame, _release_frame, self, camera, held)
+        return held
+
+    def add(self, camera, nbytes):
+        with self._lock:
+            self._usage[camera] = self._usage.get(camera, 0) + nbytes
+            self._total += nbytes
+
+    def usage(self, camera):
+        return self._usage.get(camera, 0)
+
+    @property
+    def total(self):
+        return self._total
+
+    def shed(self, threshold, work, logger=LOGGER):
+        """Returns True if work with the given threshold should be skipped"""
+        if not self.budget:
+            return False
+
+        over_budget = self._total > self.budget * threshold
+        if over_budget and work not in self._shedding:
+            self._shedding.add(work)
+            logger.warning(
+                f"Frames are using {self._total / 1024 ** 2:.0f} MB of the "
+                f"{self.budget / 1024 ** 2:.0f} MB frame memory budget, "
+                f"skipping {work}. Usage per camera: "
+                + ", ".join(
+                    f"{camera}: {usage / 1024 ** 2:.0f} MB"
+                    for camera, usage in self._usage.items()
+                )
+            )
+        elif not over_budget and work in self._shedding:
+            self._shedding.discard(work)
+            logger.info(f"Frame memory usage is below budget, resuming {work}")
+        return over_budget
@@ -1,14 +1,13 @@
 import logging
 import math
 from collections import Counter
-from queue import Full, Queue
-from typing import Any, Tuple
+from typing import Dict, Tuple
 
 import cv2
 import numpy as np
 
 import slugify as unicode_slug
-from const import FONT, FONT_SIZE, FONT_THICKNESS
+from const import FONT, FONT_SIZE, FONT_THICKNESS, POST_PROCESSOR_CROP_PADDING
 
 LOGGER = logging.getLogger(__name__)
 
@@ -130,25 +129,6 @@ def draw_objects(frame, objects, camera_resolution):
         draw_object(frame, obj, camera_resolution)
 
 
-def draw_zones(frame, zones):
-    for zone in zones:
-        if zone.objects_in_zone:
-            color = (0, 255, 0)
-        else:
-            color = (0, 0, 255)
-        cv2.polylines(frame, [zone.coordinates], True, color, 2)
-
-        cv2.putText(
-            frame,
-            zone.name,
-            (zone.coordinates[0][0] + 5, zone.coordinates[0][1] + 15),
-            FONT,
-            FONT_SIZE,
-            color,
-            FONT_THICKNESS,
-        )
-
-
 def draw_contours(frame, contours, resolution, threshold):
     filtered_contours = []
     relevant_contours = []
@@ -163,67 +143,50 @@ def draw_contours(frame, contours, resolution, threshold):
     cv2.drawContours(frame, filtered_contours, -1, (130, 0, 75), thickness=1)
 
 
-def draw_mask(frame, mask_points):
-    mask_overlay = frame.copy()
-    # Draw polygon filled with black color
-    cv2.fillPoly(
-        mask_overlay, pts=mask_points, color=(0),
-    )
-    # Apply overlay on frame with 70% opacity
-    cv2.addWeighted(
-        mask_overlay, 0.7, frame, 1 - 0.7, 0, frame,
-    )
-    # Draw polygon outline in orange
-    cv2.polylines(frame, mask_points, True, (0, 140, 255), 2)
-    for mask in mask_points:
-        image_moment = cv2.moments(mask)
-        center_x = int(image_moment["m10"] / image_moment["m00"])
-        center_y = int(image_moment["m01"] / image_moment["m00"])
-        cv2.putText(
-            frame,
-            "Mask",
-            (center_x - 20, center_y + 5),
-            FONT,
-            FONT_SIZE,
-            (255, 255, 255),
-            FONT_THICKNESS,
-        )
-
-
-def pop_if_full(queue: Queue, item: Any, logger=LOGGER, name="unknown", warn=False):
-    """If queue is full, pop oldest item and put the new item"""
-    try:
-        queue.put_nowait(item)
-    except Full:
-        if warn:
-            logger.warning(f"{name} queue is full. Removing oldest entry")
-        queue.get()
-        queue.put_nowait(item)
-
-
 def slugify(text: str) -> str:
     """Slugify a given text."""
     return unicode_slug.slugify(text, separator="_")
 
 
 def send_to_post_processor(
-    logger, camera_config, post_processors, post_processor, frame, obj, zone=None
+    logger,
+    camera_config,
+    post_processors,
+    post_processor,
+    frame,
+    obj,
+    zone=None,
+    group=None,
 ):
-    try:
-        post_processors[post_processor].input_queue.put(
-            {
-                "camera_config": camera_config,
-                "frame": frame,
-                "object": obj,
-                "zone": zone,
-            }
-        )
-    except KeyError:
+    """Sends a padded crop of the object to a post processor. The frame itself is
+    not kept, so it can be released while the crop waits in the queue.
+    Objects sent with the same group are kept together in the queue, by default
+    the objects of the same frame"""
+    if post_processor not in post_processors:
         logger.error(
             "Configured post_processor "
             f"{post_processor} "
             "does not exist. Please check your configuration"
         )
+        return
+
+    crop = frame.crop(
+        (obj.rel_x1, obj.rel_y1, obj.rel_x2, obj.rel_y2), POST_PROCESSOR_CROP_PADDING
+    )
+    if crop is None:
+        logger.debug(f"Could not crop {obj.label} for post processor")
+        return
+
+    post_processors[post_processor].input_queue.put(
+        camera_config.camera.name,
+        {
+            "camera_config": camera_config,
+            "group": frame.sequence if group is None else group,
+            "crop": crop,
+            "object": obj,
+            "zone": zone,
+        },
+    )
 
 
 def report_labels(
@@ -292,6 +255,30 @@ class Filter:
             and self.filter_height(obj)
         )
 
+    @property
+    def label(self):
+        return self._label
+
+    @property
+    def confidence(self):
+        return self._confidence
+
+    @property
+    def width_min(self):
+        return self._width_min
+
+    @property
+    def width_max(self):
+        return self._width_max
+
+    @property
+    def height_min(self):
+        return self._height_min
+
+    @property
+    def height_max(self):
+        return self._height_max
+
     @property
     def triggers_recording(self):
         return self._triggers_recording
@@ -299,3 +286,52 @@ class Filter:
     @property
     def post_processor(self):
         return self._post_processor
+
+
+class Filters:
+    """Vectorized version of Filter for a whole set of labels.
+    The thresholds of each Filter are compiled into arrays sorted by label, which
+    makes it possible to filter all Detections of a frame in a few array operations
+    """
+
+    def __init__(self, object_filters: Dict[str, Filter]):
+        self._object_filters = object_filters
+        labels = sorted(object_filters)
+        self._labels = np.array(labels, dtype=str)
+        self._confidence = np.array(
+            [object_filters[label].confidence for label in labels], dtype=np.float64
+        )
+        self._width_min = np.array(
+            [object_filters[label].width_min for label in labels], dtype=np.float64
+        )
+        self._width_max = np.array(
+            [object_filters[label].width_max for label in labels], dtype=np.float64
+        )
+        self._height_min = np.array(
+            [object_filters[label].height_min for label in labels], dtype=np.float64
+        )
+        self._height_max = np.array(
+            [object_filters[label].height_max for label in labels], dtype=np.float64
+        )
+
+    def filter_detections(self, detections):
+        """Returns a boolean mask of the detections that passes its label filter"""
+        if not len(detections) or not len(self._labels):
+            return np.zeros(len(detections), dtype=bool)
+
+        index = np.searchsorted(self._labels, detections.labels)
+        index = np.minimum(index, len(self._labels) - 1)
+        return (
+            (self._labels[index] == detections.labels)
+            & (detections.confidences > self._confidence[index])
+            & (self._width_max[index] > detections.widths)
+            & (detections.widths > self._width_min[index])
+            & (self._height_max[index] > detections.heights)
+            & (detections.heights > self._height_min[index])
+        )
+
+    def get(self, label):
+        return self._object_filters.get(label)
+
+    def __getitem__(self, label):
+        return self._object_filters[label]
@@ -0,0 +1,56 @@
+import logging
+
+import cv2
+import numpy as np
+
+LOGGER = logging.getLogger(__name__)
+
+try:
+    from turbojpeg import TJPF_BGR, TJSAMP_420, TurboJPEG
+
+    TURBO_JPEG = TurboJPEG()
+except (ImportError, OSError, RuntimeError):
+    LOGGER.debug("libjpeg-turbo not available, falling back to OpenCV JPEG encoder")
+    TURBO_JPEG = None
+
+DEFAULT_QUALITY = 95
+
+
+def encode(image, quality=DEFAULT_QUALITY):
+    """Encodes a BGR image to JPEG. Returns None if encoding failed"""
+    if isinstance(image, cv2.UMat):
+        image = image.get()
+
+    if TURBO_JPEG:
+        return TURBO_JPEG.encode(
+            np.ascontiguousarray(image),
+            quality=quality,
+            pixel_format=TJPF_BGR,
+            jpeg_subsample=TJSAMP_420,
+        )
+
+    ret, jpg = cv2.imencode(".jpg", image, [int(cv2.IMWRITE_JPEG_QUALITY), quality])
+    if ret:
+        return jpg.tobytes()
+    return None
+
+
+def encode_nv12(raw_frame, width, height, quality=DEFAULT_QUALITY):
+    """Encodes a raw NV12 frame to JPEG.
+    With libjpeg-turbo the frame is encoded straight from its YUV planes, which
+    skips the conversion to BGR completely"""
+    nv12 = np.frombuffer(raw_frame, np.uint8)
+
+    # libjpeg-turbo expects plane rows padded to 4 bytes. The unpadded planes below
+    # only match that if the chroma planes are a multiple of 4 wide
+    if TURBO_JPEG and width % 8 == 0 and height % 2 == 0:
+        luma_size = width * height
+        chroma = nv12[luma_size:].reshape(-1, 2)
+        i420 = np.concatenate((nv12[:luma_size], chroma[:, 0], chroma[:, 1]))
+        return TURBO_JPEG.encode_from_yuv(
+            i420, height, width, quality=quality, jpeg_subsample=TJSAMP_420
+        )
+
+    # Same conversion as the rest of the frame consumers, see Frame
+    image = cv2.cvtColor(nv12.reshape(int(height * 1.5), width), cv2.COLOR_YUV2RGB_NV21)
+    return encode(image, quality)
@@ -0,0 +1,57 @@
+import logging
+from collections import deque
+from queue import Empty
+from threading import Event
+
+LOGGER = logging.getLogger(__name__)
+
+
+class Mailbox:
+    """Hands the latest items over from producers to consumers.
+    Holds at most slots items. Putting an item in a full mailbox overwrites the
+    oldest one, so producers never block. Appending to and popping from a deque
+    with a maxlen are atomic, so no lock is taken on either side. The event only
+    wakes up consumers waiting on an empty mailbox"""
+
+    def __init__(self, slots=1, name="unknown", logger=LOGGER, warn=False):
+        self._items: deque = deque(maxlen=slots)
+        self._ready = Event()
+        self._name = name
+        self._logger = logger
+        self._warn = warn
+        self._dropped = 0
+
+    def put(self, item):
+        if len(self._items) == self._items.maxlen:
+            self._dropped += 1
+            if self._warn:
+                self._logger.warning(
+                    f"{self._name} is full. Removing oldest entry. "
+                    f"Dropped entries: {self._dropped}"
+                )
+        self._items.append(item)
+        self._ready.set()
+
+    def get_nowait(self):
+        try:
+            return self._items.popleft()
+        except IndexError:
+            raise Empty from None
+
+    def get(self):
+        """Returns the oldest item, waiting for one if the mailbox is empty"""
+        while True:
+            try:
+                return self._items.popleft()
+            except IndexError:
+                pass
+            self._ready.wait()
+            # Items put after this are picked up by the popleft above
+            self._ready.clear()
+
+    @property
+    def dropped(self):
+        return self._dropped
+
+    def __len__(self):
+        return len(self._items)
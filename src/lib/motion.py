@@ -3,7 +3,7 @@ import logging
 import cv2
 import numpy as np
 
-from lib.helpers import calculate_relative_contours, pop_if_full
+from lib.helpers import calculate_relative_contours
 
 
 class Contours:
@@ -103,7 +103,8 @@ class MotionDetection:
     def motion_detection(self, motion_queue):
         while True:
             frame = motion_queue.get()
+            if frame["frame"].is_stale(self._config.camera.max_frame_age):
+                continue
             frame["frame"].motion_contours = self.detect(frame)
-            pop_if_full(
-                frame["motion_return_queue"], frame,
-            )
+            frame["frame"].release_resized(frame["decoder_name"])
+            frame["motion_return_queue"].put(frame)
@@ -1,6 +1,10 @@
 import logging
+import time
+from collections import OrderedDict
+from threading import Condition
 
 import paho.mqtt.client as mqtt
+from lib.mqtt.discovery import DiscoveryManager
 from lib.nvr import FFMPEGNVR
 from lib.post_processors import PostProcessor
 
@@ -16,12 +20,83 @@ MQTT_RC = {
 }
 
 
+PUBLISH_BATCH_SIZE = 50
+STATISTICS_INTERVAL = 60
+
+
+class MQTTPublishQueue:
+    """Holds messages waiting to be published.
+    Only the newest pending payload of each topic is kept, and payloads that are
+    identical to the last published payload of the topic are dropped.
+    This means put never blocks, and the queue can never grow beyond the number of
+    topics"""
+
+    def __init__(self):
+        self._pending: OrderedDict = OrderedDict()
+        self._published: dict = {}
+        self._condition = Condition()
+        self._coalesced = 0
+        self._dropped = 0
+
+    def put(self, message):
+        topic, payload = message["topic"], message["payload"]
+        with self._condition:
+            if topic in self._pending:
+                self._coalesced += 1
+                del self._pending[topic]
+
+            if self._published.get(topic) == payload:
+                self._dropped += 1
+                return
+
+            self._pending[topic] = payload
+            self._condition.notify()
+
+    def get_batch(self, max_messages=PUBLISH_BATCH_SIZE):
+        """Blocks until messages are pending and returns up to max_messages of them
+        as (topic, payload) tuples, oldest first"""
+        with self._condition:
+            while not self._pending:
+                self._condition.wait()
+
+            batch = []
+            while self._pending and len(batch) < max_messages:
+                topic, payload = self._pending.popitem(last=False)
+                self._published[topic] = payload
+                batch.append((topic, payload))
+            return batch
+
+    def reset_published(self):
+        """Forgets what has been published, used when the broker might have lost
+        the retained messages, eg on reconnect"""
+        with self._condition:
+            self._published.clear()
+
+    def is_published(self, topic):
+        """Returns True if a payload has been published to topic since the last
+        reset"""
+        with self._condition:
+            return topic in self._published
+
+    @property
+    def coalesced(self):
+        """Number of pending messages replaced by a newer payload on the same topic"""
+        return self._coalesced
+
+    @property
+    def dropped(self):
+        """Number of messages dropped since they equal the last published payload"""
+        return self._dropped
+
+
 class MQTT:
-    def __init__(self, config):
+    def __init__(self, config, publish_queue):
         LOGGER.info("Initializing MQTT connection")
         self.config = config
         self.client = None
         self.subscriptions = []
+        self._publish_queue = publish_queue
+        self._discovery = DiscoveryManager(config, publish_queue)
 
     # pylint: disable=unused-argument
     def on_connect(self, client, userdata, flags, returncode):
@@ -32,17 +107,23 @@ class MQTT:
                 f"{MQTT_RC.get(returncode, 'Unknown error')}"
             )
 
+        self._publish_queue.reset_published()
+
+        # Send initial alive message
+        client.publish(self.config.mqtt.last_will_topic, payload="alive", retain=True)
+
+        # Discovery configs and initial states are published by the discovery
+        # manager to not block the network loop of the client
+        self._discovery.start(client)
         self.subscriptions = {}
         for nvr in FFMPEGNVR.nvr_list:
             for name in list(nvr):
-                subscriptions = nvr[name].on_connect(client)
+                subscriptions = nvr[name].on_connect(self._discovery)
                 self.subscribe(subscriptions)
 
         for post_processor in PostProcessor.post_processor_list:
-            post_processor.on_connect(client)
-
-        # Send initial alive message
-        client.publish(self.config.mqtt.last_will_topic, payload="alive", retain=True)
+            post_processor.on_connect(self._discovery)
+        self._discovery.finish()
 
     def on_message(self, client, userdata, msg):
         LOGGER.debug(f"Got topic {msg.topic}, message {str(msg.payload.decode())}")
@@ -75,9 +156,16 @@ class MQTT:
 
         self.subscriptions.update(subscription)
 
-    def publisher(self, mqtt_queue):
+    def publisher(self):
+        """Publishes messages from the publish queue in batches"""
+        next_statistics = time.monotonic() + STATISTICS_INTERVAL
         while True:
-            message = mqtt_queue.get()
-            self.client.publish(
-                message["topic"], payload=message["payload"], retain=True
-            )
+            for topic, payload in self._publish_queue.get_batch():
+                self.client.publish(topic, payload=payload, retain=True)
+
+            if time.monotonic() >= next_statistics:
+                next_statistics = time.monotonic() + STATISTICS_INTERVAL
+                LOGGER.debug(
+                    f"Coalesced messages: {self._publish_queue.coalesced}, "
+                    f"dropped duplicate messages: {self._publish_queue.dropped}"
+                )
@@ -0,0 +1,105 @@
+import hashlib
+import logging
+import time
+from queue import Empty, Queue
+from threading import Lock, Thread
+
+import paho.mqtt.client as mqtt
+
+LOGGER = logging.getLogger(__name__)
+
+# Max number of messages per second published after a (re)connect
+DISCOVERY_RATE = 100
+
+
+class DiscoveryManager:
+    """Publishes Home Assistant discovery configs and initial states on connect.
+    The manager is handed to each devices on_connect in place of the MQTT client.
+    Messages are then published from a separate thread at a limited rate.
+    All discovery configs are published on the first connect. On reconnects,
+    configs that are unchanged since they were last published are skipped. The
+    hashes of published configs are only kept in memory, so a restart always
+    publishes everything again.
+    Messages are tagged with the connection they were queued for, and the publisher
+    holds a lock while publishing, so a reconnect never interleaves with a message
+    queued for the previous connection"""
+
+    def __init__(self, config, publish_queue):
+        self._publish_queue = publish_queue
+        self._discovery_prefix = f"{config.mqtt.home_assistant.discovery_prefix}/"
+        self._cache: dict = {}  # topic: hash of the last published config
+        self._client = None
+        self._queue: Queue = Queue()
+        self._lock = Lock()
+        self._connection = 0
+        self._published = 0
+        self._skipped = 0
+
+        discovery_thread = Thread(target=self.publisher)
+        discovery_thread.daemon = True
+        discovery_thread.start()
+
+    def start(self, client):
+        """Called when the MQTT connection is established.
+        Discards messages left over from a previous connection"""
+        with self._lock:
+            self._client = client
+            self._connection += 1
+            self._published = 0
+            self._skipped = 0
+            try:
+                while True:
+                    self._queue.get_nowait()
+            except Empty:
+                pass
+
+    def publish(self, topic, payload=None, retain=False):
+        """Queues a message. Same signature as paho.mqtt.client.Client.publish"""
+        self._queue.put((self._connection, (topic, payload, retain)))
+
+    def finish(self):
+        """Called when all devices have queued their messages"""
+        self._queue.put((self._connection, None))
+
+    def is_unchanged(self, topic, payload_hash):
+        return self._cache.get(topic, None) == payload_hash
+
+    def publish_message(self, message):
+        """Publishes a message unless it can be skipped. Returns True if the message
+        was published"""
+        if message is None:
+            LOGGER.debug(
+                f"Discovery done. Published {self._published} messages, "
+                f"skipped {self._skipped} unchanged messages"
+            )
+            return False
+
+        topic, payload, retain = message
+        # Dont overwrite a state which has been published since connecting
+        if not retain and self._publish_queue.is_published(topic):
+            self._skipped += 1
+            return False
+
+        payload_hash = None
+        if retain and topic.startswith(self._discovery_prefix):
+            payload_hash = hashlib.sha1(str(payload).encode()).hexdigest()
+            if self.is_unchanged(topic, payload_hash):
+                self._skipped += 1
+                return False
+
+        result = self._client.publish(topic, payload=payload, retain=retain)
+        if payload_hash and result.rc == mqtt.MQTT_ERR_SUCCESS:
+            self._cache[topic] = payload_hash
+        self._published += 1
+        return True
+
+    def publisher(self):
+        while True:
+            connection, message = self._queue.get()
+            with self._lock:
+                # Messages queued before a reconnect are queued again by the devices
+                if connection != self._connection:
+                    continue
+                published = self.publish_message(message)
+            if published:
+                time.sleep(1 / DISCOVERY_RATE)
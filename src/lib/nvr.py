@@ -1,5 +1,7 @@
 import logging
-from queue import Empty, Queue
+import math
+import time
+from queue import Empty
 from threading import Thread
 from typing import List
 
@@ -7,34 +9,44 @@ import cv2
 
 from const import LOG_LEVELS
 from lib.camera import FFMPEGCamera
+from lib import jpeg
+from lib.frame_memory import SHED_PUBLISH_IMAGE, frame_memory
 from lib.helpers import (
     Filter,
+    Filters,
     draw_contours,
-    draw_mask,
     draw_objects,
-    draw_zones,
     report_labels,
-    send_to_post_processor,
 )
+from lib.mailbox import Mailbox
 from lib.motion import MotionDetection
 from lib.mqtt.binary_sensor import MQTTBinarySensor
 from lib.mqtt.camera import MQTTCamera
 from lib.mqtt.switch import MQTTSwitch
 from lib.mqtt.sensor import MQTTSensor
+from lib.overlay import Overlay
 from lib.recorder import FFMPEGRecorder
-from lib.zones import Zone
+from lib.snapshots import PostProcessorDispatcher, SnapshotSelector
+from lib.zones import Zone, ZoneRaster
 
 LOGGER = logging.getLogger(__name__)
 
 
 class MQTT:
-    def __init__(self, config, mqtt_queue):
+    def __init__(self, config, mqtt_queue, camera_resolution):
         self.config = config
         self.mqtt_queue = mqtt_queue
+        self._camera_resolution = camera_resolution
 
         self._status_state = None
         self.status_attributes = {}
 
+        self._overlay = None
+        self._image_resolution = self.image_resolution(
+            config.camera.publish_image, camera_resolution
+        )
+        self._image_queue = Mailbox(name="image publisher")
+
         self.devices = {}
         if self.mqtt_queue:
             self.devices["motion_detected"] = MQTTBinarySensor(
@@ -51,34 +63,125 @@ class MQTT:
             self.devices["camera"] = MQTTCamera(config, mqtt_queue)
             self.devices["sensor"] = MQTTSensor(config, mqtt_queue, "status")
 
-    def publish_image(self, object_frame, motion_frame, zones, resolution):
+            if config.camera.publish_image.enable:
+                image_publisher = Thread(target=self.image_publisher)
+                image_publisher.daemon = True
+                image_publisher.start()
+
+    @staticmethod
+    def image_resolution(publish_image, camera_resolution):
+        """Returns the resolution of published images.
+        If only one of width and height is given the aspect ratio is kept"""
+        width, height = publish_image.width, publish_image.height
+        if width and height:
+            return width, height
+        if width:
+            return width, round(camera_resolution[1] * width / camera_resolution[0])
+        if height:
+            return round(camera_resolution[0] * height / camera_resolution[1]), height
+        return camera_resolution
+
+    def publish_image(self, object_frame, motion_frame, zones):
+        """Hands the frame over to the image publisher thread.
+        If the publisher is busy, the waiting frame is replaced by this one"""
         if self.mqtt_queue:
+            if frame_memory().shed(SHED_PUBLISH_IMAGE, "publishing images"):
+                return
+            if self._overlay is None:
+                self._overlay = Overlay(
+                    self.config.motion_detection.mask, zones, self._camera_resolution
+                )
+
             # Draw on the object frame if it is supplied
             frame = object_frame if object_frame else motion_frame
-            if self.config.motion_detection.mask:
-                draw_mask(
-                    frame.decoded_frame_mat_rgb, self.config.motion_detection.mask,
-                )
+            frame.hold()
+            self._image_queue.put(
+                {
+                    "frame": frame,
+                    "motion_contours": frame.motion_contours if motion_frame else None,
+                    "zones_active": [bool(zone.objects_in_zone) for zone in zones],
+                }
+            )
 
-            if motion_frame and frame.motion_contours:
-                draw_contours(
-                    frame.decoded_frame_mat_rgb,
-                    frame.motion_contours,
-                    resolution,
-                    self.config.motion_detection.area,
-                )
+    @staticmethod
+    def image_state(image):
+        """Returns what is drawn on an image, used to skip unchanged images"""
+        return (
+            [(obj.formatted, obj.relevant) for obj in image["frame"].objects],
+            [
+                contour.tobytes()
+                for contour in getattr(image["motion_contours"], "rel_contours", [])
+            ],
+            image["zones_active"],
+        )
 
-            draw_zones(frame.decoded_frame_mat_rgb, zones)
-            draw_objects(
-                frame.decoded_frame_mat_rgb, frame.objects, resolution,
+    def draw_image(self, image):
+        frame = image["frame"].decoded_frame_mat_rgb
+        if self._image_resolution != self._camera_resolution:
+            frame = cv2.resize(
+                frame, self._image_resolution, interpolation=cv2.INTER_AREA
             )
+        else:
+            # Copy to not draw on the frame used by other consumers
+            frame = frame.copy()
 
-            # Write a low quality image to save bandwidth
-            ret, jpg = cv2.imencode(
-                ".jpg", frame.decoded_frame_mat_rgb, [int(cv2.IMWRITE_JPEG_QUALITY), 75]
+        self._overlay.draw_mask(frame)
+
+        if image["motion_contours"]:
+            draw_contours(
+                frame,
+                image["motion_contours"],
+                self._image_resolution,
+                self.config.motion_detection.area,
             )
-            if ret:
-                self.devices["camera"].publish(jpg.tobytes())
+
+        self._overlay.draw_zones(frame, image["zones_active"])
+        draw_objects(
+            frame, image["frame"].objects, self._image_resolution,
+        )
+        return frame
+
+    def encode_image(self, image, quality):
+        if (
+            self._image_resolution == self._camera_resolution
+            and not self.config.motion_detection.mask
+            and not any(image["zones_active"])
+            and not image["motion_contours"]
+            and not len(image["frame"].objects)
+        ):
+            # Nothing to draw, use the frame encoded straight from its YUV planes
+            return image["frame"].jpeg(quality)
+        return jpeg.encode(self.draw_image(image), quality)
+
+    def image_publisher(self):
+        """Draws, encodes and publishes images handed over by publish_image.
+        Publishing is limited to one image per configured interval"""
+        publish_image = self.config.camera.publish_image
+        last_published = 0.0
+        last_state = None
+        while True:
+            image = self._image_queue.get()
+
+            wait = last_published + publish_image.interval - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+                # Use the latest image which might have arrived while waiting
+                try:
+                    image = self._image_queue.get_nowait()
+                except Empty:
+                    pass
+
+            if publish_image.skip_unchanged:
+                state = self.image_state(image)
+                if state == last_state:
+                    continue
+                last_state = state
+
+            jpg = self.encode_image(image, publish_image.quality)
+            image["frame"].done()
+            if jpg:
+                self.devices["camera"].publish(jpg)
+            last_published = time.monotonic()
 
     @property
     def status_state(self):
@@ -113,7 +216,7 @@ class FFMPEGNVR(Thread):
         # Use FFMPEG to read from camera. Used for reading/recording
         self.camera = FFMPEGCamera(config)
 
-        self._mqtt = MQTT(config, mqtt_queue)
+        self._mqtt = MQTT(config, mqtt_queue, self.camera.resolution)
         self.config = config
         self.kill_received = False
         self.camera_grabber = None
@@ -121,21 +224,36 @@ class FFMPEGNVR(Thread):
         self._objects_in_fov = []
         self._labels_in_fov = []
         self._reported_label_count = {}
-        self.idle_frames = 0
+        # time.monotonic() timestamps of when the event went idle and of the last
+        # check while motion alone kept the event active
+        self._idle_since = None
+        self._recorder_countdown = None
         self._motion_frames = 0
         self._motion_detected = False
-        self._motion_only_frames = 0
+        self._motion_only_since = None
+        # Seconds that motion alone has kept the event active
+        self._motion_only_time = 0.0
         self._motion_max_timeout_reached = False
 
         self.detector = detector
 
-        self._post_processors = post_processors
+        self._post_processor_dispatcher = PostProcessorDispatcher(
+            self._logger, config, post_processors
+        )
+        # Best frame of the current event, used for the recording thumbnail
+        self._snapshot = SnapshotSelector()
 
-        self._object_decoder_queue = Queue(maxsize=2)
-        self._motion_decoder_queue = Queue(maxsize=2)
-        motion_queue = Queue(maxsize=2)
-        self.object_return_queue = Queue(maxsize=2)
-        self.motion_return_queue = Queue(maxsize=2)
+        self._object_decoder_queue = Mailbox(
+            2, name="object_decoder_queue", logger=self._logger, warn=True
+        )
+        self._motion_decoder_queue = Mailbox(
+            2, name="motion_decoder_queue", logger=self._logger, warn=True
+        )
+        motion_queue = Mailbox(
+            2, name="motion_detection input", logger=self._logger, warn=True
+        )
+        self.object_return_queue = Mailbox(2, name="object_return_queue")
+        self.motion_return_queue = Mailbox(2, name="motion_return_queue")
 
         if config.motion_detection.trigger_detector:
             self.camera.scan_for_motion.set()
@@ -144,21 +262,28 @@ class FFMPEGNVR(Thread):
             self.camera.scan_for_objects.set()
             self.camera.scan_for_motion.clear()
 
-        self._object_filters = {}
-        for object_filter in config.object_detection.labels:
-            self._object_filters[object_filter.label] = Filter(object_filter)
+        self._object_filters = Filters(
+            {
+                object_filter.label: Filter(object_filter)
+                for object_filter in config.object_detection.labels
+            }
+        )
 
         self._zones = []
-        for zone in config.camera.zones:
+        for index, zone in enumerate(config.camera.zones):
             self._zones.append(
                 Zone(
                     zone,
+                    index,
                     self.camera.resolution,
                     config,
                     self._mqtt.mqtt_queue,
-                    post_processors,
+                    self._post_processor_dispatcher,
                 )
             )
+        self._zone_raster = (
+            ZoneRaster(self._zones, self.camera.resolution) if self._zones else None
+        )
 
         # Motion detector class.
         if config.motion_detection.timeout or config.motion_detection.trigger_detector:
@@ -198,7 +323,12 @@ class FFMPEGNVR(Thread):
         # Initialize recorder
         self._trigger_recorder = False
         self._start_recorder = False
-        self.recorder = FFMPEGRecorder(config, self.detector.detection_lock, mqtt_queue)
+        self.recorder = FFMPEGRecorder(
+            config,
+            self.detector.detection_lock,
+            mqtt_queue,
+            packet_buffer=self.camera.packet_buffer,
+        )
 
         self.nvr_list.append({config.camera.mqtt_name: self})
         self._logger.debug("NVR thread initialized")
@@ -271,18 +401,24 @@ class FFMPEGNVR(Thread):
         self.camera.release()
         self.camera_grabber.join()
         if self.recorder.is_recording:
-            self.recorder.stop_recording()
+            self.recorder.stop_recording(self._snapshot.reset())
 
     def event_over(self):
         if self._trigger_recorder or any(zone.trigger_recorder for zone in self._zones):
             self._motion_max_timeout_reached = False
-            self._motion_only_frames = 0
+            self._motion_only_since = None
+            self._motion_only_time = 0.0
             return False
-        if self.config.motion_detection.timeout and self.motion_detected:
+        if not self.motion_detected:
+            # Gaps between motion do not count towards max_timeout
+            self._motion_only_since = None
+        elif self.config.motion_detection.timeout:
             # Only allow motion to keep event active for a specified period of time
-            if self._motion_only_frames >= (
-                self.camera.stream.fps * self.config.motion_detection.max_timeout
-            ):
+            now = time.monotonic()
+            if self._motion_only_since is not None:
+                self._motion_only_time += now - self._motion_only_since
+            self._motion_only_since = now
+            if self._motion_only_time >= self.config.motion_detection.max_timeout:
                 if not self._motion_max_timeout_reached:
                     self._motion_max_timeout_reached = True
                     self._logger.debug(
@@ -290,14 +426,24 @@ class FFMPEGNVR(Thread):
                         "event considered over anyway"
                     )
                 return True
-            self._motion_only_frames += 1
             return False
         return True
 
+    def record(self, frame, objects):
+        """Starts the recorder. frame is held until the thumbnail is created"""
+        try:
+            self.recorder.start_recording(frame, objects, self.camera.resolution)
+        finally:
+            if frame:
+                frame.done()
+
     def start_recording(self, frame):
+        self._snapshot.reset()
+        self._snapshot.offer(frame, self.objects_in_fov)
+        if frame:
+            frame.hold()
         recorder_thread = Thread(
-            target=self.recorder.start_recording,
-            args=(frame, self.objects_in_fov, self.camera.resolution),
+            target=self.record, args=(frame, self.objects_in_fov),
         )
         recorder_thread.start()
         if (
@@ -308,56 +454,65 @@ class FFMPEGNVR(Thread):
             self._logger.info("Starting motion detector")
 
     def stop_recording(self):
-        if self.idle_frames % self.camera.stream.fps == 0:
-            self._logger.info(
-                "Stopping recording in: {}".format(
-                    int(
-                        self.config.recorder.timeout
-                        - (self.idle_frames / self.camera.stream.fps)
-                    )
-                )
-            )
-
-        if self.idle_frames >= (self.camera.stream.fps * self.config.recorder.timeout):
+        """Stops the recorder once the event has been idle for recorder.timeout
+        seconds"""
+        if self._idle_since is None:
+            self._idle_since = time.monotonic()
+        idle_time = time.monotonic() - self._idle_since
+
+        countdown = math.ceil(self.config.recorder.timeout - idle_time)
+        if countdown != self._recorder_countdown:
+            self._recorder_countdown = countdown
+            self._logger.info(f"Stopping recording in: {max(countdown, 0)}")
+
+        if idle_time >= self.config.recorder.timeout:
+            self._idle_since = None
+            self._recorder_countdown = None
             if not self.config.motion_detection.trigger_detector:
                 self.camera.scan_for_motion.clear()
                 self._logger.info("Pausing motion detector")
 
-            self.recorder.stop_recording()
+            self.recorder.stop_recording(self._snapshot.reset())
 
     def get_processed_object_frame(self):
         """ Returns a frame along with its detections which has been processed
         by the object detector """
         try:
-            return self.object_return_queue.get_nowait()["frame"]
+            frame = self.object_return_queue.get_nowait()["frame"]
         except Empty:
             return None
+        return self.log_result_age(frame, self._object_logger)
+
+    @staticmethod
+    def log_result_age(frame, logger):
+        """Logs the time from capture to result. Results are never dropped for
+        their age, since inference on a slow detector can take longer than
+        max_frame_age. Stale frames are dropped before inference instead"""
+        logger.debug(f"Result for frame {frame.sequence} after {frame.age:.3f}s")
+        return frame
 
     def filter_fov(self, frame):
         objects_in_fov = []
         labels_in_fov = []
         self._trigger_recorder = False
-        for obj in frame.objects:
-            if self._object_filters.get(obj.label) and self._object_filters[
-                obj.label
-            ].filter_object(obj):
-                obj.relevant = True
-                objects_in_fov.append(obj)
-                labels_in_fov.append(obj.label)
-
-                if self._object_filters[obj.label].triggers_recording:
-                    self._trigger_recorder = True
-
-                # Send detection to configured post processors
-                if self._object_filters[obj.label].post_processor:
-                    send_to_post_processor(
-                        self._logger,
-                        self.config,
-                        self._post_processors,
-                        self._object_filters[obj.label].post_processor,
-                        frame,
-                        obj,
-                    )
+        passed = self._object_filters.filter_detections(frame.objects)
+        frame.objects.relevant[passed] = True
+        post_processor_objects = {}
+        for obj in frame.objects.select(passed):
+            objects_in_fov.append(obj)
+            labels_in_fov.append(obj.label)
+
+            if self._object_filters[obj.label].triggers_recording:
+                self._trigger_recorder = True
+
+            if self._object_filters[obj.label].post_processor:
+                post_processor_objects.setdefault(
+                    self._object_filters[obj.label].post_processor, []
+                ).append(obj)
+
+        # Send detections to configured post processors
+        for post_processor, objects in post_processor_objects.items():
+            self._post_processor_dispatcher.offer(post_processor, frame, objects)
 
         self.objects_in_fov = objects_in_fov
         self.labels_in_fov = labels_in_fov
@@ -393,16 +548,21 @@ class FFMPEGNVR(Thread):
         )
 
     def filter_zones(self, frame):
+        if not self._zones:
+            return
+
+        zone_membership = self._zone_raster.lookup(frame.objects)
         for zone in self._zones:
-            zone.filter_zone(frame)
+            zone.filter_zone(frame, zone_membership)
 
     def get_processed_motion_frame(self):
         """ Returns a frame along with its motion contours which has been processed
         by the motion detector """
         try:
-            return self.motion_return_queue.get_nowait()["frame"]
+            frame = self.motion_return_queue.get_nowait()["frame"]
         except Empty:
             return None
+        return self.log_result_age(frame, self._motion_logger)
 
     def filter_motion(self, motion_contours):
         _motion_found = bool(
@@ -490,10 +650,10 @@ class FFMPEGNVR(Thread):
         self.camera.frame_ready.wait()
         self._logger.debug("First frame received")
 
-        self.idle_frames = 0
         while not self.kill_received:
             self.update_status_sensor()
-            self.camera.frame_ready.wait()
+            # Timeouts are based on time, so keep going even if no frames arrive
+            self.camera.frame_ready.wait(1)
 
             # Filter returned objects
             processed_object_frame = self.get_processed_object_frame()
@@ -502,6 +662,9 @@ class FFMPEGNVR(Thread):
                 self.filter_fov(processed_object_frame)
                 # Filter objects in each zone
                 self.filter_zones(processed_object_frame)
+                if self.recorder.is_recording:
+                    self.recorder.add_objects(self.objects_in_fov, self._zones)
+                    self._snapshot.offer(processed_object_frame, self.objects_in_fov)
 
                 if self._object_logger.level == LOG_LEVELS["DEBUG"]:
                     if self.config.object_detection.log_all_objects:
@@ -517,29 +680,33 @@ class FFMPEGNVR(Thread):
                 # self._logger.debug(processed_motion_frame.motion_contours)
                 self.filter_motion(processed_motion_frame.motion_contours)
 
+            self._post_processor_dispatcher.dispatch()
             self.process_object_event()
             self.process_motion_event()
 
             if (
                 processed_object_frame or processed_motion_frame
-            ) and self.config.camera.publish_image:
+            ) and self.config.camera.publish_image.enable:
                 self._mqtt.publish_image(
-                    processed_object_frame,
-                    processed_motion_frame,
-                    self._zones,
-                    self.camera.resolution,
+                    processed_object_frame, processed_motion_frame, self._zones,
                 )
 
             # If we are recording and no object is detected
-            if self._start_recorder:
-                self._start_recorder = False
+            start_recorder, self._start_recorder = self._start_recorder, False
+            if start_recorder:
                 self.start_recording(processed_object_frame)
-            elif self.recorder.is_recording and self.event_over():
-                self.idle_frames += 1
+
+            # The NVR is done with the full size frames, see Frame.hold
+            for frame in (processed_object_frame, processed_motion_frame):
+                if frame:
+                    frame.done()
+
+            if not start_recorder and self.recorder.is_recording and self.event_over():
                 self.stop_recording()
                 continue
 
-            self.idle_frames = 0
+            self._idle_since = None
+            self._recorder_countdown = None
 
         self._logger.info("Exiting NVR thread")
 
@@ -553,4 +720,4 @@ class FFMPEGNVR(Thread):
 
         # Stop potential recording
         if self.recorder.is_recording:
-            self.recorder.stop_recording()
+            self.recorder.stop_recording(self._snapshot.reset())
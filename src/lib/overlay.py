@@ -0,0 +1,164 @@
+import logging
+
+import cv2
+import numpy as np
+
+from const import FONT, FONT_SIZE, FONT_THICKNESS
+
+LOGGER = logging.getLogger(__name__)
+
+ZONE_COLOR_ACTIVE = (0, 255, 0)
+ZONE_COLOR_INACTIVE = (0, 0, 255)
+
+
+# Layers covering less than this fraction of their bounding rectangle, such as
+# outlines, are blended pixel by pixel instead of over the whole rectangle
+SPARSE_COVERAGE = 0.5
+
+
+class OverlayLayer:
+    """A pre-rendered layer consisting of a color image and an alpha map.
+    Only the pixels the layer covers are stored, so blending touches only the pixels
+    that are actually changed by the layer. Filled layers store the bounding
+    rectangle of the covered area, sparse layers the indices of each pixel"""
+
+    def __init__(self, color, alpha):
+        rows = np.flatnonzero(alpha.any(axis=1))
+        cols = np.flatnonzero(alpha.any(axis=0))
+        if not len(rows):
+            self._roi = None
+            return
+
+        y1, y2, x1, x2 = rows[0], rows[-1] + 1, cols[0], cols[-1] + 1
+        self._roi = (slice(y1, y2), slice(x1, x2))
+        pixels = np.nonzero(alpha)
+        if len(pixels[0]) < (y2 - y1) * (x2 - x1) * SPARSE_COVERAGE:
+            self._roi = pixels
+
+        alpha = alpha[self._roi][..., np.newaxis]
+        self._premultiplied = color[self._roi].astype(np.float32) * alpha
+        self._inverted_alpha = 1.0 - alpha
+
+    def blend(self, frame):
+        """Blends the layer onto frame in place"""
+        if self._roi is None:
+            return
+        frame[self._roi] = frame[self._roi] * self._inverted_alpha + self._premultiplied
+
+
+def create_canvas(resolution):
+    return (
+        np.zeros((resolution[1], resolution[0], 3), np.uint8),
+        np.zeros((resolution[1], resolution[0]), np.float32),
+    )
+
+
+def scale_points(points, from_resolution, to_resolution):
+    return np.multiply(np.divide(points, from_resolution), to_resolution).astype(
+        "int32"
+    )
+
+
+def render_mask(resolution, mask_points):
+    color, alpha = create_canvas(resolution)
+    # Polygon filled with black color with 70% opacity
+    cv2.fillPoly(alpha, pts=mask_points, color=0.7)
+
+    # Polygon outline in orange
+    cv2.polylines(color, mask_points, True, (0, 140, 255), 2)
+    cv2.polylines(alpha, mask_points, True, 1.0, 2)
+    for mask in mask_points:
+        image_moment = cv2.moments(mask)
+        center_x = int(image_moment["m10"] / image_moment["m00"])
+        center_y = int(image_moment["m01"] / image_moment["m00"])
+        for canvas, text_color in ((color, (255, 255, 255)), (alpha, 1.0)):
+            cv2.putText(
+                canvas,
+                "Mask",
+                (center_x - 20, center_y + 5),
+                FONT,
+                FONT_SIZE,
+                text_color,
+                FONT_THICKNESS,
+            )
+    return OverlayLayer(color, alpha)
+
+
+def render_zone(resolution, name, coordinates, zone_color):
+    color, alpha = create_canvas(resolution)
+    for canvas, canvas_color in ((color, zone_color), (alpha, 1.0)):
+        cv2.polylines(canvas, [coordinates], True, canvas_color, 2)
+        cv2.putText(
+            canvas,
+            name,
+            (coordinates[0][0] + 5, coordinates[0][1] + 15),
+            FONT,
+            FONT_SIZE,
+            canvas_color,
+            FONT_THICKNESS,
+        )
+    return OverlayLayer(color, alpha)
+
+
+class Overlay:
+    """Draws the static parts of published images, masks and zones.
+    Each layer is rendered once per resolution and then blended onto every frame.
+    Coordinates of masks and zones are scaled from camera_resolution"""
+
+    def __init__(self, mask_points, zones, camera_resolution):
+        self._mask_points = mask_points
+        self._zones = zones
+        self._camera_resolution = camera_resolution
+        self._layers = {}
+
+    def render_layers(self, resolution):
+        LOGGER.debug(
+            f"Rendering overlay layers for resolution {resolution[0]}x{resolution[1]}"
+        )
+        mask_layer = None
+        if self._mask_points:
+            mask_layer = render_mask(
+                resolution,
+                [
+                    scale_points(mask, self._camera_resolution, resolution)
+                    for mask in self._mask_points
+                ],
+            )
+
+        zone_layers = []
+        for zone in self._zones:
+            coordinates = scale_points(
+                zone.coordinates, self._camera_resolution, resolution
+            )
+            zone_layers.append(
+                {
+                    True: render_zone(
+                        resolution, zone.name, coordinates, ZONE_COLOR_ACTIVE
+                    ),
+                    False: render_zone(
+                        resolution, zone.name, coordinates, ZONE_COLOR_INACTIVE
+                    ),
+                }
+            )
+        return {"mask": mask_layer, "zones": zone_layers}
+
+    def layers(self, resolution):
+        if resolution not in self._layers:
+            self._layers[resolution] = self.render_layers(resolution)
+        return self._layers[resolution]
+
+    @staticmethod
+    def frame_resolution(frame):
+        return frame.shape[1], frame.shape[0]
+
+    def draw_mask(self, frame):
+        layer = self.layers(self.frame_resolution(frame))["mask"]
+        if layer:
+            layer.blend(frame)
+
+    def draw_zones(self, frame, zones_active):
+        """Draws zones, zones_active holds a bool for each zone which decides its
+        color"""
+        zone_layers = self.layers(self.frame_resolution(frame))["zones"]
+        for active, layers in zip(zones_active, zone_layers):
+            layers[active].blend(frame)
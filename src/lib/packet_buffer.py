@@ -0,0 +1,139 @@
+import os
+import time
+from collections import deque
+from threading import Lock
+
+import numpy as np
+
+TS_PACKET_SIZE = 188
+TS_SYNC_BYTE = 0x47
+READ_SIZE = TS_PACKET_SIZE * 512
+
+
+def keyframe_packets(packets):
+    """Returns a boolean mask of the MPEG-TS packets which has the random access
+    indicator set, which ffmpeg sets on packets that start a keyframe"""
+    has_adaptation_field = (packets[:, 3] & 0x20) != 0
+    return (
+        (packets[:, 0] == TS_SYNC_BYTE)
+        & has_adaptation_field
+        & (packets[:, 4] > 0)
+        & ((packets[:, 5] & 0x40) != 0)
+    )
+
+
+class PacketBuffer:
+    """Keeps the latest compressed packets of a camera in memory.
+    ffmpeg writes the stream as MPEG-TS to a pipe, and the packets are stored in
+    blocks that each start with a keyframe. Blocks older than lookback are dropped,
+    as well as the oldest blocks if the buffer grows beyond max_size bytes. If a
+    single block outgrows max_size, eg because of a very long GOP or a stream
+    without random access indicators, it is dropped as well and buffering resumes
+    at the next keyframe.
+    While a recording is active all packets are also written to the recording file,
+    starting with the buffered blocks covering the lookback"""
+
+    def __init__(self, logger, lookback, max_size):
+        self._logger = logger
+        self._lookback = lookback
+        self._max_size = max_size
+        self._blocks: deque = deque()  # [timestamp, bytearray]
+        self._size = 0
+        self._dropped_blocks = 0
+        self._remainder = b""
+        self._recording_file = None
+        self._lock = Lock()
+
+    def read_pipe(self, read_fd):
+        """Reads from the ffmpeg pipe until it is closed"""
+        self._logger.debug("Starting packet buffer reader")
+        self._remainder = b""
+        with os.fdopen(read_fd, "rb", buffering=0) as pipe:
+            while True:
+                data = pipe.read(READ_SIZE)
+                if not data:
+                    break
+                self.feed(data)
+        self._logger.debug("Packet buffer reader stopped")
+
+    def feed(self, data):
+        data = self._remainder + data
+        usable = len(data) - len(data) % TS_PACKET_SIZE
+        self._remainder = data[usable:]
+        if not usable:
+            return
+
+        packets = np.frombuffer(data, np.uint8, count=usable).reshape(
+            -1, TS_PACKET_SIZE
+        )
+        keyframes = np.flatnonzero(keyframe_packets(packets)) * TS_PACKET_SIZE
+        now = time.time()
+        with self._lock:
+            if self._recording_file:
+                self._recording_file.write(data[:usable])
+
+            # Data before the first keyframe belongs to the current block
+            start = 0
+            for keyframe in keyframes:
+                self.append(data[start:keyframe], now)
+                self._blocks.append([now, bytearray()])
+                start = keyframe
+            self.append(data[start:usable], now)
+            self.evict(now)
+
+    def append(self, data, now):
+        if not data:
+            return
+        if not self._blocks:
+            # Packets before the first keyframe cannot be decoded on their own
+            return
+        self._blocks[-1][1] += data
+        self._size += len(data)
+
+    def evict(self, now):
+        # Keep the newest block which started before the lookback
+        while len(self._blocks) > 1 and self._blocks[1][0] <= now - self._lookback:
+            self.pop_block()
+
+        while len(self._blocks) > 1 and self._size > self._max_size:
+            self.pop_block()
+
+        if self._blocks and self._size > self._max_size:
+            # Data is ignored until the next keyframe starts a new block
+            self.pop_block()
+            self._dropped_blocks += 1
+            message = (
+                f"Keyframe block is larger than the packet buffer of "
+                f"{self._max_size} bytes, dropping it and waiting for the next "
+                f"keyframe. Dropped blocks: {self._dropped_blocks}"
+            )
+            if self._dropped_blocks == 1:
+                self._logger.warning(message)
+            else:
+                self._logger.debug(message)
+
+    def pop_block(self):
+        _, block = self._blocks.popleft()
+        self._size -= len(block)
+
+    def start_recording(self, file_name):
+        """Writes the buffered lookback to file_name and keeps writing packets to it
+        until stop_recording is called"""
+        with self._lock:
+            self._recording_file = open(file_name, "wb")
+            for _, block in self._blocks:
+                self._recording_file.write(block)
+        self._logger.debug(
+            f"Wrote {self._size} buffered bytes from {len(self._blocks)} "
+            f"keyframe blocks to {file_name}"
+        )
+
+    def stop_recording(self):
+        with self._lock:
+            if self._recording_file:
+                self._recording_file.close()
+                self._recording_file = None
+
+    @property
+    def size(self):
+        return self._size
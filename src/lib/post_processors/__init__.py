@@ -1,7 +1,8 @@
 import importlib
 import logging
-from queue import Queue
-from threading import Thread
+import time
+from collections import OrderedDict
+from threading import Condition, Lock, Thread
 from typing import Dict
 
 from lib.config import ViseronConfig
@@ -10,6 +11,110 @@ from lib.config.config_post_processors import PostProcessorsConfig
 
 LOGGER = logging.getLogger(__name__)
 
+# Seconds between each summary of post processor statistics
+STATS_INTERVAL = 60
+
+
+class PostProcessorQueue:
+    """Input queue of a post processor which never blocks the caller.
+    Each camera only keeps its latest group of objects, usually the objects of one
+    frame. When objects from a newer group are queued, the pending objects of the
+    older group are dropped.
+    Cameras take turns, so a busy camera cannot starve the others"""
+
+    def __init__(self):
+        self._pending: OrderedDict = OrderedDict()  # camera: [group, [items]]
+        self._condition = Condition()
+        self._depth = 0
+        self._dropped = 0
+
+    def put(self, camera, item):
+        item["queued_at"] = time.monotonic()
+        with self._condition:
+            pending = self._pending.get(camera)
+            if pending and pending[0] == item["group"]:
+                pending[1].append(item)
+            else:
+                if pending:
+                    self._depth -= len(pending[1])
+                    self._dropped += len(pending[1])
+                    LOGGER.debug(
+                        f"Dropped {len(pending[1])} stale objects from {camera}. "
+                        f"Total dropped: {self._dropped}"
+                    )
+                self._pending[camera] = [item["group"], [item]]
+            self._depth += 1
+            self._condition.notify()
+
+    def get(self):
+        with self._condition:
+            while not self._pending:
+                self._condition.wait()
+            camera, (_, items) = next(iter(self._pending.items()))
+            item = items.pop(0)
+            if items:
+                self._pending.move_to_end(camera)
+            else:
+                del self._pending[camera]
+            self._depth -= 1
+            return item
+
+    @property
+    def depth(self):
+        return self._depth
+
+    @property
+    def dropped(self):
+        return self._dropped
+
+
+class ProcessingStats:
+    """Collects the processing time and queue wait time of processed items.
+    A summary is logged every STATS_INTERVAL seconds while items are processed,
+    along with the depth and drop count of the queue, if any"""
+
+    def __init__(self, name, logger=LOGGER, queue=None):
+        self._name = name
+        self._logger = logger
+        self._queue = queue
+        self._lock = Lock()
+        self.reset(time.monotonic())
+
+    def reset(self, now):
+        self._started = now
+        self._items = 0
+        self._processing_time = 0.0
+        self._max_processing_time = 0.0
+        self._wait_time = 0.0
+        self._max_wait_time = 0.0
+
+    def record(self, processing_time, wait_time, items=1):
+        now = time.monotonic()
+        with self._lock:
+            self._items += items
+            self._processing_time += processing_time
+            self._max_processing_time = max(
+                self._max_processing_time, processing_time
+            )
+            self._wait_time += wait_time * items
+            self._max_wait_time = max(self._max_wait_time, wait_time)
+            if now - self._started < STATS_INTERVAL:
+                return
+            summary = (
+                f"{self._name}: processed {self._items} items in the last "
+                f"{now - self._started:.0f}s. "
+                f"Processing time avg {self._processing_time / self._items:.3f}s, "
+                f"max {self._max_processing_time:.3f}s. "
+                f"Queue wait avg {self._wait_time / self._items:.3f}s, "
+                f"max {self._max_wait_time:.3f}s"
+            )
+            self.reset(now)
+        if self._queue is not None:
+            summary += f". Queue depth: {self._queue.depth}"
+            if getattr(self._queue, "dropped", None) is not None:
+                summary += f", dropped: {self._queue.dropped}"
+        self._logger.info(summary)
+
 
 class PostProcessor:
     post_processor_list: list = []
@@ -24,18 +129,21 @@ class PostProcessor:
         LOGGER.debug(f"Initializing post processor {processor_type}")
         processor = self.import_processor(processor_type, processor_config)
         LOGGER.debug("Successfully imported post processor")
-        self.input_queue: Queue = Queue(maxsize=10)
+        self.input_queue = PostProcessorQueue()
+        processor_config = processor.Config(
+            config.post_processors, processor.SCHEMA(processor_config)
+        )
         self._post_processor = processor.Processor(
-            config,
-            processor.Config(
-                config.post_processors, processor.SCHEMA(processor_config)
-            ),
-            mqtt_queue,
+            config, processor_config, mqtt_queue,
+        )
+        self._stats = ProcessingStats(
+            f"Post processor {processor_type}", queue=self.input_queue
         )
 
-        processor_thread = Thread(target=self.post_process)
-        processor_thread.daemon = True
-        processor_thread.start()
+        for _ in range(processor_config.workers):
+            processor_thread = Thread(target=self.post_process)
+            processor_thread.daemon = True
+            processor_thread.start()
 
         LOGGER.debug(f"Post processor {processor_type} initialized")
 
@@ -48,8 +156,20 @@ class PostProcessor:
     def post_process(self):
         while True:
             item = self.input_queue.get()
-            self._post_processor.process(
-                item["camera_config"], item["frame"], item["object"], item["zone"]
+            start = time.monotonic()
+            try:
+                self._post_processor.process(
+                    item["camera_config"], item["crop"], item["object"], item["zone"]
+                )
+            except Exception:  # pylint: disable=broad-except
+                LOGGER.exception("Post processor failed")
+            self._stats.record(time.monotonic() - start, start - item["queued_at"])
+            LOGGER.debug(
+                f"Processed object from {item['camera_config'].camera.name} in "
+                f"{time.monotonic() - start:.3f}s, "
+                f"{start - item['queued_at']:.3f}s after it was queued. "
+                f"Queue depth: {self.input_queue.depth}, "
+                f"dropped: {self.input_queue.dropped}"
             )
 
     def on_connect(self, client):
@@ -68,7 +188,12 @@ class PostProcessorConfig:
         self._logging = getattr(post_processors_config, "logging", None)
         if processor_config.get("logging", None):
             self._logging = LoggingConfig(processor_config["logging"])
+        self._workers = processor_config["workers"]
 
     @property
     def logging(self):
         return self._logging
+
+    @property
+    def workers(self):
+        return self._workers
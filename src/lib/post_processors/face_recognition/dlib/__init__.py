@@ -1,25 +1,36 @@
+import hashlib
 import logging
 import math
 import os
 import os.path
 import pickle
-from threading import Thread, Timer
+import time
+from queue import Empty, Queue
+from threading import Event, Lock, Thread, Timer, current_thread
 from time import sleep
 
 from voluptuous import All, Any, Coerce, Optional, Range
 
+import cv2
+import dlib
 import face_recognition
+import numpy as np
 from const import ENV_CUDA_SUPPORTED
 from face_recognition.face_recognition_cli import image_files_in_folder
 from lib.config import ViseronConfig
-from lib.helpers import calculate_absolute_coords, slugify
+from lib.helpers import slugify
 from lib.mqtt.binary_sensor import MQTTBinarySensor
-from lib.post_processors import PostProcessorConfig
+from lib.post_processors import PostProcessorConfig, ProcessingStats
 from lib.post_processors.schema import SCHEMA as BASE_SCHEMA
 import PIL
-from sklearn import neighbors
 
-from .defaults import EXPIRE_AFTER, FACE_RECOGNITION_PATH
+from .defaults import (
+    EXPIRE_AFTER,
+    FACE_BATCH_SIZE,
+    FACE_RECOGNITION_PATH,
+    MAX_CROP_SIZE,
+    RECOGNIZED_OVERLAP,
+)
 
 
 def get_default_model() -> str:
@@ -47,6 +58,17 @@ class Config(PostProcessorConfig):
         self._face_recognition_path = processor_config["face_recognition_path"]
         self._expire_after = processor_config["expire_after"]
         self._model = processor_config["model"]
+        if self._workers > 1:
+            LOGGER.warning(
+                "workers is not supported by dlib, faces are recognized in batches "
+                "by a single thread"
+            )
+
+    @property
+    def workers(self):
+        """Objects are only queued for the recognizer, which runs in a single
+        thread since the dlib models can not be used by several threads at once"""
+        return 1
 
     @property
     def face_recognition_path(self):
@@ -69,46 +91,133 @@ class Processor:
         self._processor_config = processor_config
 
         self._faces: dict = {}
-        self._classifier, tracked_faces = train(processor_config.face_recognition_path)
+        self._faces_lock = Lock()
+        # Serve the previously trained model until training is done
+        self._classifier = load_model(processor_config.face_recognition_path)
+        self._training_done = Event()
+        tracked_faces = face_names(processor_config.face_recognition_path)
 
         # Create one MQTT binary sensor per tracked face
         self._mqtt_devices = {}
         if mqtt_queue:
-            for face in list(set(tracked_faces)):
+            for face in tracked_faces:
                 LOGGER.debug(f"Creating MQTT binary sensor for face {face}")
                 self._mqtt_devices[face] = FaceMQTTBinarySensor(
                     config, mqtt_queue, face
                 )
 
+        training_thread = Thread(target=self.train)
+        training_thread.daemon = True
+        training_thread.start()
+
+        # Boxes where a face was recently recognized, per camera
+        self._recognized: dict = {}
+        self._recognized_lock = Lock()
+        # Bounded so that a slow recognizer blocks the post processor queue
+        self._crop_queue: Queue = Queue(maxsize=FACE_BATCH_SIZE * 2)
+        self._stats = ProcessingStats("dlib recognizer", LOGGER)
+        recognizer_thread = Thread(target=self.recognizer)
+        recognizer_thread.daemon = True
+        recognizer_thread.start()
+
         LOGGER.debug("dlib initialized")
 
-    def process(self, camera_config, frame, obj, zone):
+    def train(self):
+        classifier, _ = train(self._processor_config.face_recognition_path)
+        if classifier:
+            self._classifier = classifier
+        self._training_done.set()
+
+    def process(self, camera_config, crop, obj, zone):
         if not self._classifier:
+            if not self._training_done.is_set():
+                LOGGER.debug("Skipping face recognition, classifier is being trained")
+                return
             LOGGER.error(
                 "Classifier has not been trained, "
                 "make sure the folder structure of faces is correct"
             )
             return
 
-        height, width, _ = frame.decoded_frame_mat_rgb.shape
-        x1, y1, x2, y2 = calculate_absolute_coords(
-            (obj.rel_x1, obj.rel_y1, obj.rel_x2, obj.rel_y2,), (width, height),
-        )
-        cropped_frame = frame.decoded_frame_mat_rgb[y1:y2, x1:x2].copy()
+        camera = camera_config.camera.name
+        box = (obj.rel_x1, obj.rel_y1, obj.rel_x2, obj.rel_y2)
+        face = self.recently_recognized(camera, box)
+        if face:
+            LOGGER.debug(f"Skipping crop, {face} was recently recognized here")
+            self.face_detected(face)
+            return
 
-        faces = predict(
-            cropped_frame, self._classifier, model=self._processor_config.model
-        )
-        LOGGER.debug(f"Faces found: {faces}")
+        cropped_frame = crop.image
+        crop_height, crop_width, _ = cropped_frame.shape
+        scale = MAX_CROP_SIZE / max(crop_height, crop_width, 1)
+        if scale < 1:
+            cropped_frame = cv2.resize(
+                cropped_frame,
+                (int(crop_width * scale), int(crop_height * scale)),
+                interpolation=cv2.INTER_AREA,
+            )
 
-        for face, coordinates in [
-            (face, coordinates) for face, coordinates in faces if face != "unknown"
-        ]:
+        self._crop_queue.put((camera, box, cropped_frame, time.monotonic()))
+
+    def recently_recognized(self, camera, box):
+        """Returns the face recognized within expire_after seconds in a box which
+        overlaps the given box, if any"""
+        now = time.monotonic()
+        with self._recognized_lock:
+            recognized = [
+                entry
+                for entry in self._recognized.get(camera, [])
+                if now - entry[2] < self._processor_config.expire_after
+            ]
+            self._recognized[camera] = recognized
+            for recognized_box, face, _ in recognized:
+                if box_overlap(box, recognized_box) >= RECOGNIZED_OVERLAP:
+                    return face
+        return None
+
+    def recognizer(self):
+        """Recognizes faces in the queued crops. All crops waiting in the queue,
+        from all cameras, are encoded and matched together"""
+        while True:
+            batch = [self._crop_queue.get()]
+            while len(batch) < FACE_BATCH_SIZE:
+                try:
+                    batch.append(self._crop_queue.get_nowait())
+                except Empty:
+                    break
+
+            start = time.monotonic()
+            results = predict(
+                [crop for _, _, crop, _ in batch],
+                self._classifier,
+                model=self._processor_config.model,
+            )
+            self._stats.record(
+                time.monotonic() - start,
+                start - sum(queued_at for *_, queued_at in batch) / len(batch),
+                items=len(batch),
+            )
+            for (camera, box, _, _), faces in zip(batch, results):
+                LOGGER.debug(f"Faces found: {faces}")
+                for face, coordinates in faces:
+                    if face == "unknown":
+                        continue
+                    with self._recognized_lock:
+                        self._recognized.setdefault(camera, []).append(
+                            (box, face, time.monotonic())
+                        )
+                    self.face_detected(face, coordinates)
+
+    def face_detected(self, face, coordinates=None):
+        with self._faces_lock:
             # Cancel the expiry timer if face has already been detected
             if self._faces.get(face, None):
                 self._faces[face]["timer"].cancel()
+                if coordinates is None:
+                    coordinates = self._faces[face]["coordinates"]
 
-            self._mqtt_devices[face].publish(True)
+            if face in self._mqtt_devices:
+                self._mqtt_devices[face].publish(True)
 
             # Adds a detected face and schedules an expiry timer
             self._faces[face] = {
@@ -120,23 +229,261 @@ class Processor:
             self._faces[face]["timer"].start()
 
     def expire_face(self, face):
-        LOGGER.debug(f"Expiring face {face}")
-        self._mqtt_devices[face].publish(False)
-        del self._faces[face]
+        with self._faces_lock:
+            # The face was detected again while this timer was firing
+            if self._faces.get(face, {}).get("timer") is not current_thread():
+                return
+            LOGGER.debug(f"Expiring face {face}")
+            if face in self._mqtt_devices:
+                self._mqtt_devices[face].publish(False)
+            self._faces.pop(face, None)
 
     def on_connect(self, client):
         for device in self._mqtt_devices.values():
             device.on_connect(client)
 
 
+class FaceMatcher:
+    """Matches face encodings against the encodings of all known faces.
+    The known encodings are kept as one contiguous float32 matrix, so the distances
+    from all query faces to all known faces are computed in a single matrix
+    operation. Each face is labeled by a distance weighted vote among its
+    n_neighbors closest known faces, like a k-nearest neighbors classifier.
+    New people can be added without retraining the existing ones"""
+
+    def __init__(self, n_neighbors=None):
+        self._n_neighbors = n_neighbors
+        self._encodings = np.empty((0, 128), dtype=np.float32)
+        self._squared_norms = np.empty(0, dtype=np.float32)
+        self._labels = np.empty(0, dtype=np.intp)
+        self._names: list = []
+        self._lock = Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = Lock()
+
+    @property
+    def names(self):
+        return list(self._names)
+
+    def __len__(self):
+        return len(self._labels)
+
+    @property
+    def n_neighbors(self):
+        if self._n_neighbors is None:
+            return max(1, int(round(math.sqrt(len(self)))))
+        return self._n_neighbors
+
+    def add(self, name, encodings):
+        """Adds encodings of a person. Encodings of an already known person are
+        appended to the existing ones"""
+        encodings = np.ascontiguousarray(encodings, dtype=np.float32).reshape(-1, 128)
+        with self._lock:
+            if name not in self._names:
+                self._names.append(name)
+            label = self._names.index(name)
+            self._encodings = np.concatenate((self._encodings, encodings))
+            self._squared_norms = np.concatenate(
+                (self._squared_norms, np.einsum("ij,ij->i", encodings, encodings))
+            )
+            self._labels = np.concatenate(
+                (self._labels, np.full(len(encodings), label, dtype=np.intp))
+            )
+
+    def match(self, encodings, distance_threshold=0.6):
+        """Returns a (name, distance) tuple for each encoding, where distance is the
+        distance to the closest known face. The name is None if the closest known
+        face is further away than distance_threshold"""
+        if not len(encodings):
+            return []
+        with self._lock:
+            known = self._encodings
+            squared_norms = self._squared_norms
+            labels = self._labels
+            names = list(self._names)
+        if not len(known):
+            return [(None, math.inf)] * len(encodings)
+
+        queries = np.ascontiguousarray(encodings, dtype=np.float32).reshape(-1, 128)
+        # |a - b|^2 = |a|^2 + |b|^2 - 2ab, for all pairs at once
+        distances = (
+            np.einsum("ij,ij->i", queries, queries)[:, np.newaxis]
+            + squared_norms[np.newaxis, :]
+            - 2 * queries @ known.T
+        )
+        np.sqrt(np.maximum(distances, 0, out=distances), out=distances)
+
+        n_neighbors = min(self.n_neighbors, len(known))
+        rows = np.arange(len(queries))[:, np.newaxis]
+        neighbors = np.argpartition(distances, n_neighbors - 1, axis=1)[
+            :, :n_neighbors
+        ]
+        neighbor_distances = distances[rows, neighbors]
+        closest = neighbor_distances.min(axis=1)
+
+        # Weigh each neighbor by inverse distance. Exact matches get all the weight
+        with np.errstate(divide="ignore"):
+            weights = 1 / neighbor_distances
+        exact = np.isinf(weights)
+        weights = np.where(exact.any(axis=1)[:, np.newaxis], exact, weights)
+
+        votes = np.zeros((len(queries), len(names)), dtype=np.float32)
+        np.add.at(
+            votes, (np.broadcast_to(rows, neighbors.shape), labels[neighbors]), weights
+        )
+        best = votes.argmax(axis=1)
+
+        return [
+            (names[label] if distance <= distance_threshold else None, float(distance))
+            for label, distance in zip(best, closest)
+        ]
+
+
+class FaceEncodingCache:
+    """Face encodings of the training images, stored on disk so that only new or
+    changed images has to be encoded when training.
+    An image is considered unchanged if its mtime is the same, or if its content
+    hash is the same in case only the mtime changed. Images without exactly one
+    face are cached as None so they are not searched for faces again"""
+
+    MISSING = object()
+
+    def __init__(self, cache_file):
+        self._cache_file = cache_file
+        self._entries: dict = {}
+        self._hashes: dict = {}
+        try:
+            with open(cache_file, "rb") as cache:
+                self._entries = pickle.load(cache)
+        except FileNotFoundError:
+            pass
+        except (OSError, pickle.UnpicklingError, EOFError) as error:
+            LOGGER.warning(f"Could not read face encoding cache: {error}")
+
+    @staticmethod
+    def file_hash(img_path):
+        with open(img_path, "rb") as img_file:
+            return hashlib.sha1(img_file.read()).hexdigest()
+
+    def get(self, img_path):
+        """Returns the cached encoding, or MISSING if the image has to be encoded"""
+        mtime = os.path.getmtime(img_path)
+        entry = self._entries.get(img_path)
+        if entry and entry["mtime"] == mtime:
+            return entry["encoding"]
+
+        self._hashes[img_path] = self.file_hash(img_path)
+        if entry and entry["hash"] == self._hashes[img_path]:
+            entry["mtime"] = mtime
+            return entry["encoding"]
+        return self.MISSING
+
+    def set(self, img_path, encoding):
+        self._entries[img_path] = {
+            "mtime": os.path.getmtime(img_path),
+            "hash": self._hashes.pop(img_path, None) or self.file_hash(img_path),
+            "encoding": encoding,
+        }
+
+    def save(self, img_paths):
+        """Saves the cache, dropping images that no longer exists"""
+        self._entries = {
+            img_path: entry
+            for img_path, entry in self._entries.items()
+            if img_path in img_paths
+        }
+        try:
+            with open(self._cache_file, "wb") as cache:
+                pickle.dump(self._entries, cache)
+        except OSError as error:
+            LOGGER.warning(f"Could not save face encoding cache: {error}")
+
+
+def face_names(face_recognition_path):
+    """Returns the name of each person in the faces folder"""
+    train_dir = os.path.join(face_recognition_path, "faces")
+    try:
+        return sorted(
+            face_dir
+            for face_dir in os.listdir(train_dir)
+            if os.path.isdir(os.path.join(train_dir, face_dir))
+        )
+    except FileNotFoundError:
+        return []
+
+
+def load_model(
+    face_recognition_path, model_dir="model", model_name="trained_faces.clf"
+):
+    """Loads the classifier saved by the last training"""
+    try:
+        with open(
+            os.path.join(face_recognition_path, model_dir, model_name), "rb"
+        ) as model_file:
+            LOGGER.debug("Loading previously trained faces")
+            model = pickle.load(model_file)
+    except FileNotFoundError:
+        return None
+    except (
+        OSError,
+        pickle.UnpicklingError,
+        EOFError,
+        AttributeError,
+        ImportError,
+    ) as error:
+        LOGGER.warning(f"Could not load previously trained faces: {error}")
+        return None
+
+    # Models saved by earlier versions are replaced when training is done
+    if not isinstance(model, FaceMatcher):
+        return None
+    return model
+
+
+def encode_face(img_path):
+    """Returns the face encoding of an image, or None if the image does not contain
+    exactly one face"""
+    try:
+        image = face_recognition.load_image_file(img_path)
+    except PIL.UnidentifiedImageError as error:
+        LOGGER.error(f"Error loading image: {error}")
+        return None
+
+    face_bounding_boxes = face_recognition.face_locations(image)
+
+    if len(face_bounding_boxes) != 1:
+        # Skip image if amount of people !=1
+        LOGGER.warning(
+            "Image {} not suitable for training: {}".format(
+                img_path,
+                "Didn't find a face"
+                if len(face_bounding_boxes) < 1
+                else "Found more than one face",
+            )
+        )
+        return None
+
+    return face_recognition.face_encodings(
+        image, known_face_locations=face_bounding_boxes
+    )[0]
+
+
 def train(
     face_recognition_path,
     model_dir="model",
     model_name="trained_faces.clf",
+    cache_name="face_encodings.pkl",
     n_neighbors=None,
 ):
     """
-    Trains a k-nearest neighbors classifier for face recognition.
+    Trains a FaceMatcher, a k-nearest neighbors classifier for face recognition.
 
     :param face_recognition_path: directory that contains
         a sub-directory for each known person.
@@ -153,17 +500,22 @@ def train(
             |   |   │   ├── someimage1.jpeg
             |   |   │   ├── someimage2.png
             |   |   └── ...
+            |   |── model/
+            |   |   ├── trained_faces.clf
+            |   |   └── face_encodings.pkl
 
-    :param model_dir: (optional) path to save model on disk
+    :param model_dir: (optional) path to save model on disk,
+        relative to face_recognition_path
     :param model_name: (optional) filename of saved model
+    :param cache_name: (optional) filename of the face encoding cache
     :param n_neighbors: (optional) number of neighbors to weigh in classification.
         Chosen automatically if not specified
-    :return: returns knn classifier that was trained on the given data.
+    :return: returns the FaceMatcher that was trained on the given data.
     """
     LOGGER.debug("Training faces...")
 
-    face_encodings = []
-    face_names = []
+    matcher = FaceMatcher(n_neighbors=n_neighbors)
+    face_names_trained = []
 
     # Loop through each person in the training set
     train_dir = os.path.join(face_recognition_path, "faces")
@@ -184,6 +536,17 @@ def train(
         )
         return None, []
 
+    model_path = os.path.join(face_recognition_path, model_dir)
+    try:
+        os.makedirs(model_path)
+        LOGGER.debug(f"Model dir missing, creating {model_path}")
+    except FileExistsError:
+        pass
+
+    cache = FaceEncodingCache(os.path.join(model_path, cache_name))
+    all_img_paths = set()
+    encoded = 0
+
     for face_dir in faces_dirs:
         LOGGER.debug(f"Training face {face_dir}")
 
@@ -196,6 +559,7 @@ def train(
                 "Please remove any other files"
             )
             LOGGER.error(error)
+            continue
 
         if not img_paths:
             LOGGER.warning(
@@ -205,70 +569,93 @@ def train(
             )
             continue
 
+        face_encodings = []
         for img_path in img_paths:
-            try:
-                image = face_recognition.load_image_file(img_path)
-            except PIL.UnidentifiedImageError as error:
-                LOGGER.error(f"Error loading image: {error}")
-                continue
-
-            face_bounding_boxes = face_recognition.face_locations(image)
-
-            if len(face_bounding_boxes) != 1:
-                # Skip image if amount of people !=1
-                LOGGER.warning(
-                    "Image {} not suitable for training: {}".format(
-                        img_path,
-                        "Didn't find a face"
-                        if len(face_bounding_boxes) < 1
-                        else "Found more than one face",
-                    )
-                )
-            else:
+            all_img_paths.add(img_path)
+            encoding = cache.get(img_path)
+            if encoding is FaceEncodingCache.MISSING:
+                encoding = encode_face(img_path)
+                cache.set(img_path, encoding)
+                encoded += 1
+
+            if encoding is not None:
                 # Add face encoding for current image to the training set
-                face_encodings.append(
-                    face_recognition.face_encodings(
-                        image, known_face_locations=face_bounding_boxes
-                    )[0]
-                )
-                face_names.append(face_dir)
+                face_encodings.append(encoding)
+                face_names_trained.append(face_dir)
+
+        if face_encodings:
+            matcher.add(face_dir, face_encodings)
 
-    if not face_encodings:
+    cache.save(all_img_paths)
+    LOGGER.debug(
+        f"Encoded {encoded} new or changed images, "
+        f"{len(all_img_paths) - encoded} were cached"
+    )
+
+    if not len(matcher):
         LOGGER.error(f"No faces found for training in {train_dir}")
         return None, []
 
-    # model_path = os.path.join(train_dir, model_dir)
+    # Save the trained matcher
+    try:
+        with open(os.path.join(model_path, model_name), "wb") as model_file:
+            pickle.dump(matcher, model_file)
+    except OSError as error:
+        LOGGER.warning(f"Could not save trained faces: {error}")
 
-    # try:
-    #     os.makedirs(model_path)
-    #     LOGGER.debug(f"Model dir missing, creating {model_path}")
-    # except FileExistsError:
-    #     pass
+    LOGGER.debug("Training complete")
+    return matcher, face_names_trained
+
+
+def box_overlap(box, other_box):
+    """Returns the intersection over union of two boxes"""
+    x1, y1 = max(box[0], other_box[0]), max(box[1], other_box[1])
+    x2, y2 = min(box[2], other_box[2]), min(box[3], other_box[3])
+    intersection = max(0, x2 - x1) * max(0, y2 - y1)
+    union = (
+        (box[2] - box[0]) * (box[3] - box[1])
+        + (other_box[2] - other_box[0]) * (other_box[3] - other_box[1])
+        - intersection
+    )
+    return intersection / union if union > 0 else 0
 
-    # Determine how many neighbors to use for weighting in the KNN classifier
-    if n_neighbors is None:
-        n_neighbors = int(round(math.sqrt(len(face_encodings))))
 
-    # Create and train the KNN classifier
-    knn_clf = neighbors.KNeighborsClassifier(
-        n_neighbors=n_neighbors, algorithm="ball_tree", weights="distance"
-    )
-    knn_clf.fit(face_encodings, face_names)
+def batch_face_encodings(frames, face_locations):
+    """Returns the encodings of all faces in all frames, computed with one call to
+    dlib. Uses the same 5 point landmarks as face_recognition.face_encodings"""
+    images = []
+    shapes = []
+    for frame, locations in zip(frames, face_locations):
+        if not locations:
+            continue
+        detections = dlib.full_object_detections()
+        for top, right, bottom, left in locations:
+            detections.append(
+                face_recognition.api.pose_predictor_5_point(
+                    frame, dlib.rectangle(left, top, right, bottom)
+                )
+            )
+        images.append(frame)
+        shapes.append(detections)
 
-    # # Save the trained KNN classifier
-    # with open(os.path.join(model_path, model_name), "wb") as model_file:
-    #     pickle.dump(knn_clf, model_file)
+    if not images:
+        return [[] for _ in frames]
 
-    LOGGER.debug("Training complete")
-    return knn_clf, face_names
+    descriptors = iter(
+        face_recognition.api.face_encoder.compute_face_descriptor(images, shapes)
+    )
+    return [
+        [np.array(descriptor) for descriptor in next(descriptors)] if locations else []
+        for locations in face_locations
+    ]
 
 
-def predict(frame, knn_clf, model="hog", distance_threshold=0.6):
+def predict(frames, matcher, model="hog", distance_threshold=0.6):
     """
-    Recognizes faces in given image using a trained KNN classifier
+    Recognizes faces in given images using a trained FaceMatcher
 
-    :param frame: frame to run prediction on
-    :param knn_clf: (optional) a knn classifier object.
+    :param frames: frames to run prediction on
+    :param matcher: a trained FaceMatcher.
     :param model: Which face detection model to use.
         "hog" is less accurate but faster on CPUs.
         "cnn" is a more accurate deep-learning model which is
@@ -276,37 +663,36 @@ def predict(frame, knn_clf, model="hog", distance_threshold=0.6):
     :param distance_threshold: (optional) distance threshold for face classification.
         The chance of classifying an unknown person as a known one
         increases with this value.
-    :return: a list of names and face locations for the recognized faces in the image:
-        [(name, bounding box), ...].
+    :return: for each frame, a list of names and face locations for the recognized
+        faces in the image: [[(name, bounding box), ...], ...].
         For faces of unrecognized persons, the name 'unknown' will be returned.
     """
 
-    # Load image file and find face locations
-    face_locations = face_recognition.face_locations(frame, model=model)
-
-    # If no faces are found in the image, return an empty result.
-    if len(face_locations) == 0:
-        return []
+    # Find face locations
+    face_locations = [
+        face_recognition.face_locations(frame, model=model) for frame in frames
+    ]
 
-    # Find encodings for faces in the test iamge
-    faces_encodings = face_recognition.face_encodings(
-        frame, known_face_locations=face_locations
-    )
+    # If no faces are found in any image, return an empty result.
+    if not any(face_locations):
+        return [[] for _ in frames]
 
-    # Use the KNN model to find the best matches
-    closest_distances = knn_clf.kneighbors(faces_encodings, n_neighbors=1)
-    are_matches = [
-        closest_distances[0][i][0] <= distance_threshold
-        for i in range(len(face_locations))
+    # Find encodings for the faces in all images at once
+    faces_encodings = batch_face_encodings(frames, face_locations)
+    all_encodings = [
+        encoding for encodings in faces_encodings for encoding in encodings
     ]
 
-    # Predict classes and remove classifications that aren't within the threshold
-    return [
-        (pred, loc) if rec else ("unknown", loc)
-        for pred, loc, rec in zip(
-            knn_clf.predict(faces_encodings), face_locations, are_matches
-        )
-    ]
+    # Match all faces against the known faces at once
+    matches = iter(matcher.match(all_encodings, distance_threshold))
+    results = []
+    for locations in face_locations:
+        faces = []
+        for loc in locations:
+            name, _ = next(matches)
+            faces.append((name or "unknown", loc))
+        results.append(faces)
+    return results
 
 
 class FaceMQTTBinarySensor(MQTTBinarySensor):
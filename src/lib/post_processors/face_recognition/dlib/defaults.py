@@ -1,2 +1,8 @@
 FACE_RECOGNITION_PATH = "/config/face_recognition"
 EXPIRE_AFTER = 5
+# Max number of crops which are encoded together
+FACE_BATCH_SIZE = 8
+# Crops larger than this (longest side, in pixels) are downscaled before detection
+MAX_CROP_SIZE = 640
+# Crops overlapping a recently recognized face by at least this much (IoU) are skipped
+RECOGNIZED_OVERLAP = 0.5
@@ -1,5 +1,11 @@
-from voluptuous import Optional, Required, Schema
+from voluptuous import All, Optional, Range, Required, Schema
 
 from lib.config.config_logging import SCHEMA as LOGGING_SCHEMA
 
-SCHEMA = Schema({Required("type"): str, Optional("logging"): LOGGING_SCHEMA,})
+SCHEMA = Schema(
+    {
+        Required("type"): str,
+        Optional("workers", default=1): All(int, Range(min=1)),
+        Optional("logging"): LOGGING_SCHEMA,
+    }
+)
@@ -1,20 +1,23 @@
 import datetime
+import functools
 import logging
 import os
+import subprocess as sp
 from threading import Thread
 
-import cv2
-
+from lib import jpeg
+from lib.catalog import RecordingCatalog
 from lib.cleanup import SegmentCleanup
 from lib.helpers import draw_objects
 from lib.mqtt.camera import MQTTCamera
-from lib.segments import Segments
+from lib.recorder_jobs import RecorderJob, RecorderJobQueue
+from lib.segments import IncrementalConcat, Segments
 
 LOGGER = logging.getLogger(__name__)
 
 
 class FFMPEGRecorder:
-    def __init__(self, config, detection_lock, mqtt_queue):
+    def __init__(self, config, detection_lock, mqtt_queue, packet_buffer=None):
         self._logger = logging.getLogger(__name__ + "." + config.camera.name_slug)
         if getattr(config.recorder.logging, "level", None):
             self._logger.setLevel(config.recorder.logging.level)
@@ -23,22 +26,37 @@ class FFMPEGRecorder:
         self._logger.debug("Initializing ffmpeg recorder")
         self.config = config
         self._mqtt_queue = mqtt_queue
+        self._detection_lock = detection_lock
+        self._packet_buffer = packet_buffer
 
         self.is_recording = False
         self.last_recording_start = None
         self.last_recording_end = None
         self._event_start = None
-        self._event_end = None
         self._recording_name = None
+        self._recording_id = None
+        self._objects = {}
+        self._resolution = None
+        self._segment_pin = None
+        self._incremental = None
+        self._catalog = RecordingCatalog()
 
-        segments_folder = os.path.join(
-            config.recorder.segments_folder, config.camera.name
-        )
-        self.create_directory(segments_folder)
-        self._segmenter = Segments(
-            self._logger, config, segments_folder, detection_lock
+        self._segmenter = None
+        self._segment_cleanup = None
+        if not self._packet_buffer:
+            segments_folder = os.path.join(
+                config.recorder.segments_folder, config.camera.name
+            )
+            self.create_directory(segments_folder)
+            self._segmenter = Segments(
+                self._logger, config, segments_folder, detection_lock
+            )
+            self._segment_cleanup = SegmentCleanup(config)
+        self._jobs = RecorderJobQueue(
+            self._logger,
+            config.recorder.merge_gap,
+            config.recorder.max_concurrent_jobs,
         )
-        self._segment_cleanup = SegmentCleanup(config)
 
         self._mqtt_devices = {}
         if self.config.recorder.thumbnail.send_to_mqtt:
@@ -56,24 +74,39 @@ class FFMPEGRecorder:
         )
 
     def create_thumbnail(self, file_name, frame, objects, resolution):
-        draw_objects(
-            frame.decoded_frame_umat_rgb, objects, resolution,
-        )
-        cv2.imwrite(file_name, frame.decoded_frame_umat_rgb)
+        if objects:
+            frame.hold()
+            try:
+                thumbnail = frame.decoded_frame_mat_rgb.copy()
+            finally:
+                frame.done()
+            draw_objects(
+                thumbnail, objects, resolution,
+            )
+            jpg = jpeg.encode(thumbnail)
+        else:
+            jpg = frame.jpeg()
+
+        if jpg is None:
+            self._logger.error("Could not encode thumbnail")
+            return
+
+        # The same encoded image is used for all thumbnails
+        with open(file_name, "wb") as thumbnail_file:
+            thumbnail_file.write(jpg)
 
         if self.config.recorder.thumbnail.save_to_disk:
-            cv2.imwrite(
+            with open(
                 os.path.join(
                     self.config.recorder.folder,
                     f"{self.config.camera.name}/latest_thumbnail.jpg",
                 ),
-                frame.decoded_frame_umat_rgb,
-            )
+                "wb",
+            ) as thumbnail_file:
+                thumbnail_file.write(jpg)
 
         if self.config.recorder.thumbnail.send_to_mqtt and self._mqtt_devices:
-            ret, jpg = cv2.imencode(".jpg", frame.decoded_frame_umat_rgb)
-            if ret:
-                self._mqtt_devices["latest_thumbnail"].publish(jpg.tobytes())
+            self._mqtt_devices["latest_thumbnail"].publish(jpg)
 
     def create_directory(self, path):
         try:
@@ -86,11 +119,20 @@ class FFMPEGRecorder:
     def start_recording(self, frame, objects, resolution):
         self._logger.info("Starting recorder")
         self.is_recording = True
-        self._segment_cleanup.pause()
         now = datetime.datetime.now()
         self.last_recording_start = now.isoformat()
         self.last_recording_end = None
         self._event_start = int(now.timestamp())
+        self._objects = {}
+        self._resolution = resolution
+        self.add_objects(objects)
+        if self.continue_recording():
+            return
+
+        if self._segment_cleanup:
+            self._segment_pin = self._segment_cleanup.pin(
+                self._event_start - self.config.recorder.lookback
+            )
 
         if self.config.recorder.folder is None:
             self._logger.error("Output directory is not specified")
@@ -99,35 +141,201 @@ class FFMPEGRecorder:
         # Create filename
         now = datetime.datetime.now()
         video_name = f"{now.strftime('%H:%M:%S')}.{self.config.recorder.extension}"
-        thumbnail_name = f"{now.strftime('%H:%M:%S')}.jpg"
 
         # Create foldername
         subfolder = self.subfolder_name(now)
         full_path = os.path.join(self.config.recorder.folder, subfolder)
         self.create_directory(full_path)
 
-        if frame:
-            self.create_thumbnail(
-                os.path.join(full_path, thumbnail_name), frame, objects, resolution
-            )
-
         self._recording_name = os.path.join(full_path, video_name)
+        thumbnail_path = None
+        if frame:
+            thumbnail_path = self.thumbnail_name(self._recording_name)
+            self.create_thumbnail(thumbnail_path, frame, objects, resolution)
 
-    def concat_segments(self):
-        self._segmenter.concat_segments(
+        self._recording_id = self._catalog.add_recording(
+            self.config.camera.name,
             self._event_start - self.config.recorder.lookback,
-            self._event_end,
             self._recording_name,
+            thumbnail=thumbnail_path,
+        )
+        if self._packet_buffer:
+            self._packet_buffer.start_recording(
+                self.buffer_file_name(self._recording_name)
+            )
+        elif self.config.recorder.incremental:
+            self._incremental = IncrementalConcat(
+                self._logger,
+                self.config,
+                self._segmenter,
+                self._detection_lock,
+                self._event_start,
+                self._recording_name,
+            )
+            self._incremental.start()
+
+    def continue_recording(self):
+        """Continues the recording of a previous event if it has not been
+        concatenated yet and the recording windows are close enough"""
+        job = self._jobs.merge(self._event_start - self.config.recorder.lookback)
+        if not job:
+            return False
+
+        self._logger.info(f"Continuing recording {job.recording_name}")
+        self._event_start = job.event_start
+        self._recording_name = job.recording_name
+        self._recording_id = job.recording_id
+        self._segment_pin = job.segment_pin
+        self._segment_cleanup.update_pin(self._segment_pin, None)
+        return True
+
+    def add_objects(self, objects, zones=()):
+        """Collects a summary of the objects detected during the recording, which
+        is stored in the catalog when the recording stops"""
+        for obj in objects:
+            summary = self._objects.setdefault(obj.label, [obj.confidence, set()])
+            summary[0] = max(summary[0], obj.confidence)
+        for zone in zones:
+            for obj in zone.objects_in_zone:
+                summary = self._objects.setdefault(obj.label, [obj.confidence, set()])
+                summary[1].add(zone.name)
+
+    def update_size(self, recording_name):
+        try:
+            self._catalog.update_size(
+                recording_name, os.path.getsize(recording_name)
+            )
+        except OSError:
+            self._logger.error(f"Could not get size of recording {recording_name}")
+
+    @staticmethod
+    def buffer_file_name(recording_name):
+        return f"{recording_name}.ts"
+
+    @staticmethod
+    def thumbnail_name(recording_name):
+        return f"{os.path.splitext(recording_name)[0]}.jpg"
+
+    def convert_buffer_recording(self, job):
+        """Converts the MPEG-TS written by the packet buffer to the final recording"""
+        buffer_file = self.buffer_file_name(job.recording_name)
+        recording_name = job.recording_name
+        ffmpeg_cmd = (
+            ["ffmpeg", "-hide_banner", "-loglevel", "error", "-y"]
+            + self.config.recorder.hwaccel_args
+            + ["-f", "mpegts", "-i", buffer_file]
+            + self.config.recorder.codec
+            + self.config.recorder.filter_args
+            + ["-movflags", "+faststart"]
+            + [recording_name]
         )
-        # Dont resume cleanup if new recording started during encoding
-        if not self.is_recording:
-            self._segment_cleanup.resume()
+        self._logger.debug(f"Conversion command: {ffmpeg_cmd}")
+
+        with self._detection_lock:
+            pipe = sp.run(ffmpeg_cmd, stderr=sp.PIPE, check=False)
+        if pipe.returncode != 0:
+            self._logger.error(
+                f"Error converting recording: {pipe.stderr.decode().strip()}"
+            )
+            return
+
+        os.remove(buffer_file)
+        self.update_size(recording_name)
+        self._logger.debug("Recording converted")
+
+    def concat_segments(self, job):
+        try:
+            self._segmenter.concat_segments(
+                job.event_start - self.config.recorder.lookback,
+                job.event_end,
+                job.recording_name,
+            )
+            self.update_size(job.recording_name)
+        finally:
+            self._segment_cleanup.unpin(job.segment_pin)
+
+    def finish_incremental(self, incremental, job):
+        try:
+            incremental.join()
+            self.update_size(job.recording_name)
+        finally:
+            self._segment_cleanup.unpin(job.segment_pin)
+
+    def replace_thumbnail(self, recording_id, recording_name, snapshot, resolution):
+        thumbnail_path = self.thumbnail_name(recording_name)
+        self.create_thumbnail(thumbnail_path, *snapshot, resolution)
+        self._catalog.update_thumbnail(recording_id, thumbnail_path)
 
-    def stop_recording(self):
+    def stop_recording(self, snapshot=None):
+        """Stops the recording. snapshot is an optional (frame, objects) tuple of the
+        best frame of the event, which replaces the thumbnail"""
         self._logger.info("Stopping recorder")
         self.is_recording = False
         now = datetime.datetime.now()
         self.last_recording_end = now.isoformat()
-        self._event_end = int(now.timestamp())
-        concat_thread = Thread(target=self.concat_segments)
-        concat_thread.start()
+        event_end = int(now.timestamp())
+        if snapshot and self._recording_name:
+            thumbnail_thread = Thread(
+                target=self.replace_thumbnail,
+                args=(
+                    self._recording_id,
+                    self._recording_name,
+                    snapshot,
+                    self._resolution,
+                ),
+            )
+            thumbnail_thread.start()
+        self._catalog.finish_recording(self._recording_id, event_end)
+        self._catalog.add_objects(
+            self._recording_id,
+            {label: tuple(summary) for label, summary in self._objects.items()},
+        )
+
+        if self._packet_buffer:
+            self._packet_buffer.stop_recording()
+            self._jobs.put(
+                RecorderJob(
+                    self.convert_buffer_recording,
+                    self._event_start,
+                    event_end,
+                    self._recording_name,
+                    recording_id=self._recording_id,
+                )
+            )
+            return
+
+        if self._incremental:
+            self._segment_cleanup.update_pin(self._segment_pin, event_end)
+            self._incremental.stop(event_end)
+            self._jobs.put(
+                RecorderJob(
+                    functools.partial(self.finish_incremental, self._incremental),
+                    self._event_start,
+                    event_end,
+                    self._recording_name,
+                    recording_id=self._recording_id,
+                    segment_pin=self._segment_pin,
+                )
+            )
+            self._incremental = None
+            return
+
+        # Hold the job long enough for the next event to continue the recording
+        # if their recording windows are less than merge_gap seconds apart. The
+        # segments in between are kept until then, so the merged recording has no
+        # gaps
+        self._segment_cleanup.update_pin(
+            self._segment_pin, event_end + self._jobs.merge_gap
+        )
+        self._jobs.put(
+            RecorderJob(
+                self.concat_segments,
+                self._event_start,
+                event_end,
+                self._recording_name,
+                recording_id=self._recording_id,
+                segment_pin=self._segment_pin,
+                mergeable=True,
+                hold=self.config.recorder.lookback + self._jobs.merge_gap,
+            )
+        )
@@ -0,0 +1,119 @@
+import time
+from collections import deque
+from threading import BoundedSemaphore, Condition, Lock, Thread
+
+_ENCODE_SLOTS = None
+_ENCODE_SLOTS_LOCK = Lock()
+
+
+def encode_slots(max_concurrent_jobs):
+    """Returns the semaphore which limits the number of jobs running at the same
+    time. It is shared by all cameras"""
+    global _ENCODE_SLOTS  # pylint: disable=global-statement
+    with _ENCODE_SLOTS_LOCK:
+        if _ENCODE_SLOTS is None:
+            _ENCODE_SLOTS = BoundedSemaphore(max_concurrent_jobs)
+        return _ENCODE_SLOTS
+
+
+class RecorderJob:
+    """A finished recording waiting to be written to its final file.
+    The job is not started until hold seconds after it is queued. Until then a new
+    event can take over a mergeable job to continue the same recording"""
+
+    def __init__(
+        self,
+        target,
+        event_start,
+        event_end,
+        recording_name,
+        recording_id=None,
+        segment_pin=None,
+        mergeable=False,
+        hold=0,
+    ):
+        self.target = target
+        self.event_start = event_start
+        self.event_end = event_end
+        self.recording_name = recording_name
+        self.recording_id = recording_id
+        self.segment_pin = segment_pin
+        self.mergeable = mergeable
+        self.ready_at = time.time() + hold
+
+    def run(self):
+        self.target(self)
+
+
+class RecorderJobQueue:
+    """Runs the recorder jobs of a camera one at a time.
+    Events whose recording windows overlap or are less than merge_gap seconds apart
+    are merged into one recording, which saves concatenating the same segments
+    twice"""
+
+    def __init__(self, logger, merge_gap, max_concurrent_jobs):
+        self._logger = logger
+        self._merge_gap = merge_gap
+        self._encode_slots = encode_slots(max_concurrent_jobs)
+        self._jobs: deque = deque()
+        self._condition = Condition()
+        self._merged = 0
+
+        worker = Thread(target=self.worker)
+        worker.daemon = True
+        worker.start()
+
+    def put(self, job):
+        with self._condition:
+            self._jobs.append(job)
+            self._logger.debug(f"Recorder job queued. Queue depth: {len(self._jobs)}")
+            self._condition.notify()
+
+    def merge(self, window_start):
+        """Removes and returns the latest queued job if a recording starting at
+        window_start should continue it instead of creating a new recording"""
+        with self._condition:
+            if not self._jobs:
+                return None
+            job = self._jobs[-1]
+            if not job.mergeable or window_start > job.event_end + self._merge_gap:
+                return None
+            self._jobs.pop()
+            self._merged += 1
+            self._logger.debug(
+                f"Merging event into recording {job.recording_name}. "
+                f"Merged events: {self._merged}"
+            )
+            return job
+
+    @property
+    def merge_gap(self):
+        return self._merge_gap
+
+    @property
+    def depth(self):
+        return len(self._jobs)
+
+    def worker(self):
+        while True:
+            with self._condition:
+                while not self._jobs or self._jobs[0].ready_at > time.time():
+                    timeout = (
+                        self._jobs[0].ready_at - time.time() if self._jobs else None
+                    )
+                    self._condition.wait(timeout)
+                job = self._jobs.popleft()
+                depth = len(self._jobs)
+
+            with self._encode_slots:
+                start = time.time()
+                try:
+                    job.run()
+                except Exception:  # pylint: disable=broad-except
+                    self._logger.exception(
+                        f"Recorder job for {job.recording_name} failed"
+                    )
+                self._logger.debug(
+                    f"Recorder job for {job.recording_name} took "
+                    f"{time.time() - start:.1f}s. Queue depth: {depth}"
+                )
@@ -1,11 +1,18 @@
 import datetime
+import json
 import os
 import shutil
 import subprocess as sp
+import tempfile
 import time
+from threading import Event, Thread
 
 from const import CAMERA_SEGMENT_DURATION
 
+# Software encoders used to re-encode the start and end of a smart cut recording,
+# by the codec of the camera stream
+SMART_CUT_ENCODERS = {"h264": "libx264", "hevc": "libx265"}
+
 
 class Segments:
     def __init__(self, logger, config, segments_folder, detection_lock):
@@ -14,6 +21,10 @@ class Segments:
         self._segments_folder = segments_folder
         self._detection_lock = detection_lock
 
+    @property
+    def segments_folder(self):
+        return self._segments_folder
+
     def segment_duration(self, segment_file):
         """Returns the duration of a specified segment"""
         ffprobe_cmd = [
@@ -30,11 +41,10 @@ class Segments:
 
         tries = 0
         while True:
-            self._detection_lock.acquire()
-            pipe = sp.Popen(ffprobe_cmd, stdout=sp.PIPE, stderr=sp.PIPE)
-            (output, stderr) = pipe.communicate()
-            p_status = pipe.wait()
-            self._detection_lock.release()
+            with self._detection_lock:
+                pipe = sp.Popen(ffprobe_cmd, stdout=sp.PIPE, stderr=sp.PIPE)
+                (output, stderr) = pipe.communicate()
+                p_status = pipe.wait()
 
             if p_status == 0:
                 return float(output.decode("utf-8").strip())
@@ -68,6 +78,23 @@ class Segments:
             None,
         )
 
+    @staticmethod
+    def segment_start_time(segment):
+        return datetime.datetime.strptime(
+            segment.split(".")[0], "%Y%m%d%H%M%S"
+        ).timestamp()
+
+    def completed_segments(self, after=None, include_newest=False):
+        """Returns the sorted names of the segments newer than after.
+        The newest segment is still being written by ffmpeg and is left out unless
+        include_newest is set"""
+        segments = sorted(os.listdir(self._segments_folder))
+        if not include_newest:
+            segments = segments[:-1]
+        if after:
+            segments = [segment for segment in segments if segment > after]
+        return segments
+
     def get_segment_information(self):
         """Gets information for all available segments"""
         segment_files = os.listdir(self._segments_folder)
@@ -79,9 +106,7 @@ class Segments:
             if not duration:
                 continue
 
-            start_time = datetime.datetime.strptime(
-                segment.split(".")[0], "%Y%m%d%H%M%S"
-            ).timestamp()
+            start_time = self.segment_start_time(segment)
 
             information = {"start_time": start_time, "end_time": start_time + duration}
             segment_information[segment] = information
@@ -138,10 +163,11 @@ class Segments:
                 )
                 return concat_script
 
-    def ffmpeg_concat(self, segment_script, file_name):
+    def ffmpeg_concat(self, segment_script, file_name, stream_copy=False):
+        """Concatenates the segments in segment_script. Returns False on failure"""
         ffmpeg_cmd = (
             ["ffmpeg", "-hide_banner", "-loglevel", "error", "-y",]
-            + self._config.recorder.hwaccel_args
+            + ([] if stream_copy else self._config.recorder.hwaccel_args)
             + [
                 "-protocol_whitelist",
                 "file,pipe",
@@ -152,8 +178,11 @@ class Segments:
                 "-i",
                 "-",
             ]
-            + self._config.recorder.codec
-            + self._config.recorder.filter_args
+            + (
+                ["-c:v", "copy"]
+                if stream_copy
+                else self._config.recorder.codec + self._config.recorder.filter_args
+            )
             + ["-movflags", "+faststart"]
             + [file_name]
         )
@@ -161,11 +190,236 @@ class Segments:
         self._logger.debug(f"Concatenation command: {ffmpeg_cmd}")
         self._logger.debug(f"Segment script: \n{segment_script}")
 
-        self._detection_lock.acquire()
-        pipe = sp.run(ffmpeg_cmd, input=segment_script, encoding="ascii", check=True)
-        self._detection_lock.release()
+        with self._detection_lock:
+            pipe = sp.run(
+                ffmpeg_cmd,
+                input=segment_script,
+                stderr=sp.PIPE,
+                encoding="ascii",
+                check=False,
+            )
         if pipe.returncode != 0:
             self._logger.error(f"Error concatenating segments: {pipe.stderr}")
+            return False
+        return True
+
+    def keyframes(self, segment_file):
+        """Returns the timestamps of all keyframes in a segment"""
+        ffprobe_cmd = [
+            "ffprobe",
+            "-hide_banner",
+            "-loglevel",
+            "error",
+            "-select_streams",
+            "v:0",
+            "-skip_frame",
+            "nokey",
+            "-show_entries",
+            "frame=pts_time",
+            "-of",
+            "csv=p=0",
+            segment_file,
+        ]
+        with self._detection_lock:
+            pipe = sp.run(ffprobe_cmd, stdout=sp.PIPE, stderr=sp.PIPE, check=False)
+        if pipe.returncode != 0:
+            self._logger.error(
+                f"Could not get keyframes for: {segment_file}. "
+                f"Error: {pipe.stderr.decode()}"
+            )
+            return []
+
+        keyframes = []
+        for line in pipe.stdout.decode().split():
+            try:
+                keyframes.append(float(line.strip(",")))
+            except ValueError:
+                continue
+        return sorted(keyframes)
+
+    @staticmethod
+    def plan_smart_cut(inpoint, outpoint, duration, keyframes):
+        """Splits the part of a segment between inpoint and outpoint into a head
+        and tail which has to be re-encoded, and a middle which starts on a keyframe
+        and can be stream copied. Returns the (head_end, tail_start) boundaries"""
+        head_end = next((key for key in keyframes if key >= inpoint), outpoint)
+        head_end = min(head_end, outpoint)
+        if outpoint >= duration:
+            tail_start = outpoint
+        else:
+            tail_start = max(
+                (key for key in keyframes if key <= outpoint), default=head_end
+            )
+        return head_end, max(tail_start, head_end)
+
+    def stream_information(self, file_name):
+        """Returns the codec, profile, pixel format and resolution of the video
+        stream in a file, or None if it could not be probed"""
+        ffprobe_cmd = [
+            "ffprobe",
+            "-hide_banner",
+            "-loglevel",
+            "error",
+            "-select_streams",
+            "v:0",
+            "-show_entries",
+            "stream=codec_name,profile,pix_fmt,width,height",
+            "-of",
+            "json",
+            file_name,
+        ]
+        with self._detection_lock:
+            pipe = sp.run(ffprobe_cmd, stdout=sp.PIPE, stderr=sp.PIPE, check=False)
+        if pipe.returncode != 0:
+            self._logger.error(
+                f"Could not get stream information for: {file_name}. "
+                f"Error: {pipe.stderr.decode()}"
+            )
+            return None
+        try:
+            stream = json.loads(pipe.stdout)["streams"][0]
+        except (ValueError, KeyError, IndexError):
+            return None
+        return {
+            key: stream.get(key)
+            for key in ("codec_name", "profile", "pix_fmt", "width", "height")
+        }
+
+    @staticmethod
+    def encoder_args(stream_information):
+        """Returns encoder arguments which produce the same format as the probed
+        stream, or None if the codec has no matching encoder"""
+        encoder = SMART_CUT_ENCODERS.get(stream_information["codec_name"])
+        if not encoder:
+            return None
+        encoder_args = ["-c:v", encoder]
+        if stream_information["profile"]:
+            # ffprobe reports eg "Constrained Baseline" or "Main 10"
+            profile = stream_information["profile"].lower()
+            encoder_args += [
+                "-profile:v",
+                profile.replace("constrained ", "").replace(" ", ""),
+            ]
+        return encoder_args + [
+            "-pix_fmt",
+            stream_information["pix_fmt"],
+            "-s",
+            f"{stream_information['width']}x{stream_information['height']}",
+            # Repeat the parameter sets on each keyframe, since the stream copied
+            # parts carry parameter sets of their own
+            "-bsf:v",
+            "dump_extra",
+        ]
+
+    def encode_part(self, segment_file, start, end, file_name, stream_information):
+        """Re-encodes part of a segment to the format of the segment.
+        Returns False if it failed or the result does not match the segment"""
+        ffmpeg_cmd = (
+            ["ffmpeg", "-hide_banner", "-loglevel", "error", "-y"]
+            + ["-ss", f"{start:.3f}", "-i", segment_file, "-t", f"{end - start:.3f}"]
+            + self.encoder_args(stream_information)
+            + ["-an", file_name]
+        )
+        with self._detection_lock:
+            pipe = sp.run(ffmpeg_cmd, stderr=sp.PIPE, check=False)
+        if pipe.returncode != 0:
+            self._logger.error(
+                f"Error re-encoding part of {segment_file}: {pipe.stderr.decode()}"
+            )
+            return False
+
+        part_information = self.stream_information(file_name)
+        if part_information != stream_information:
+            self._logger.debug(
+                f"Re-encoded part {part_information} does not match "
+                f"{stream_information}"
+            )
+            return False
+        return True
+
+    def generate_smart_cut_script(
+        self, segments_to_concat, segment_information, event_start, event_end, temp_dir
+    ):
+        """Returns a concat script where segments inside the event are stream copied
+        and only the partial GOPs at the start and end of the event are re-encoded"""
+        stream_information = None
+        concat_script = []
+        for segment in segments_to_concat:
+            segment_file = os.path.join(self._segments_folder, segment)
+            # All parts are joined by stream copying, so they must share a format
+            segment_stream = self.stream_information(segment_file)
+            if stream_information is None:
+                stream_information = segment_stream
+                if not segment_stream or not self.encoder_args(segment_stream):
+                    self._logger.debug(
+                        f"Smart cut not supported for stream {segment_stream}"
+                    )
+                    return None
+            elif segment_stream != stream_information:
+                self._logger.debug(
+                    f"Segment {segment} format {segment_stream} differs from "
+                    f"{stream_information}"
+                )
+                return None
+
+            start_time = segment_information[segment]["start_time"]
+            duration = segment_information[segment]["end_time"] - start_time
+            inpoint = min(max(0, event_start - start_time), duration)
+            outpoint = max(min(duration, event_end - start_time), inpoint)
+
+            # Segments always start with a keyframe, so whole segments are copied
+            keyframes = [0.0]
+            if inpoint > 0 or outpoint < duration:
+                keyframes = self.keyframes(segment_file)
+            head_end, tail_start = self.plan_smart_cut(
+                inpoint, outpoint, duration, keyframes
+            )
+
+            parts = [
+                (inpoint, head_end, True),
+                (head_end, tail_start, False),
+                (tail_start, outpoint, True),
+            ]
+            for part_start, part_end, encode in parts:
+                if part_end - part_start <= 0:
+                    continue
+                if not encode:
+                    concat_script.append(f"file '{segment_file}'")
+                    if part_start > 0:
+                        concat_script.append(f"inpoint {part_start:.3f}")
+                    if part_end < duration:
+                        concat_script.append(f"outpoint {part_end:.3f}")
+                    continue
+
+                part_file = os.path.join(temp_dir, f"{len(concat_script)}.mp4")
+                if not self.encode_part(
+                    segment_file, part_start, part_end, part_file, stream_information
+                ):
+                    return None
+                concat_script.append(f"file '{part_file}'")
+        return "\n".join(concat_script)
+
+    def smart_cut(
+        self, segments_to_concat, segment_information, event_start, event_end, file_name
+    ):
+        """Creates a recording where only the partial GOPs are re-encoded, to the
+        format of the camera stream.
+        Returns False if the recording has to be re-encoded completely instead"""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            segment_script = self.generate_smart_cut_script(
+                segments_to_concat,
+                segment_information,
+                event_start,
+                event_end,
+                temp_dir,
+            )
+            if not segment_script:
+                self._logger.debug("Smart cut failed, re-encoding whole recording")
+                return False
+            if not self.ffmpeg_concat(segment_script, file_name, stream_copy=True):
+                self._logger.debug("Smart cut failed, re-encoding whole recording")
+                return False
+        return True
 
     def concat_segments(self, event_start, event_end, file_name):
         """Concatenates segments between event_start and event_end"""
@@ -200,11 +454,129 @@ class Segments:
 
         temp_file = os.path.join("/tmp", file_name)
 
-        self.ffmpeg_concat(
+        if self._config.recorder.smart_cut and self.smart_cut(
+            segments_to_concat, segment_information, event_start, event_end, temp_file
+        ):
+            shutil.move(temp_file, file_name)
+            self._logger.debug("Segments concatenated using smart cut")
+            return
+
+        if not self.ffmpeg_concat(
             self.generate_segment_script(
                 segments_to_concat, segment_information, event_start, event_end
             ),
             temp_file,
-        )
+        ):
+            return
         shutil.move(temp_file, file_name)
         self._logger.debug("Segments concatenated")
+
+
+class IncrementalConcat:
+    """Appends segments to a fragmented MP4 recording while the event is running.
+    Each segment is remuxed to MPEG-TS with a timestamp offset and piped to a single
+    ffmpeg process which writes the recording. The file can be played while it is
+    being written, and is done shortly after the event ends"""
+
+    def __init__(
+        self, logger, config, segmenter, detection_lock, event_start, file_name
+    ):
+        self._logger = logger
+        self._config = config
+        self._segmenter = segmenter
+        self._detection_lock = detection_lock
+        self._start = event_start - config.recorder.lookback
+        self._end = None
+        self._file_name = file_name
+        self._stop = Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = Thread(target=self.run)
+        self._thread.start()
+
+    def stop(self, event_end):
+        self._end = event_end
+        self._stop.set()
+
+    def join(self):
+        self._thread.join()
+
+    def writer_command(self):
+        return (
+            ["ffmpeg", "-hide_banner", "-loglevel", "error", "-y"]
+            + self._config.recorder.hwaccel_args
+            + ["-f", "mpegts", "-i", "pipe:0"]
+            + self._config.recorder.codec
+            + self._config.recorder.filter_args
+            + ["-movflags", "+frag_keyframe+empty_moov+default_base_moof"]
+            + [self._file_name]
+        )
+
+    def append_segment(self, writer, segment_file, inpoint, outpoint, offset):
+        ffmpeg_cmd = (
+            ["ffmpeg", "-hide_banner", "-loglevel", "error"]
+            + (["-ss", str(inpoint)] if inpoint else [])
+            + ["-i", segment_file]
+            + (["-t", str(outpoint - inpoint)] if outpoint is not None else [])
+            + ["-c", "copy", "-output_ts_offset", str(offset)]
+            + ["-f", "mpegts", "pipe:1"]
+        )
+        with self._detection_lock:
+            pipe = sp.run(ffmpeg_cmd, stdout=writer.stdin, check=False)
+        if pipe.returncode != 0:
+            self._logger.error(f"Error appending segment {segment_file}")
+
+    def run(self):
+        self._logger.debug(f"Incremental recording command: {self.writer_command()}")
+        writer = sp.Popen(self.writer_command(), stdin=sp.PIPE)
+        last_segment = None
+        offset = 0.0
+        stopped_at = None
+        done = False
+
+        while not done:
+            if self._stop.is_set():
+                time.sleep(1)
+            else:
+                self._stop.wait(CAMERA_SEGMENT_DURATION)
+            if self._stop.is_set() and not stopped_at:
+                stopped_at = time.time()
+
+            # If the segment containing the end of the event does not complete in
+            # time, the camera has most likely stopped. Use what is available
+            include_newest = bool(
+                stopped_at and time.time() - stopped_at > CAMERA_SEGMENT_DURATION + 5
+            )
+            segments = self._segmenter.completed_segments(
+                after=last_segment, include_newest=include_newest
+            )
+            for segment in segments:
+                last_segment = segment
+                segment_file = os.path.join(self._segmenter.segments_folder, segment)
+                start_time = self._segmenter.segment_start_time(segment)
+                if self._end is not None and start_time > self._end:
+                    done = True
+                    break
+
+                duration = self._segmenter.segment_duration(segment_file)
+                if not duration or start_time + duration <= self._start:
+                    continue
+
+                inpoint = max(0, int(self._start - start_time))
+                outpoint = None
+                if self._end is not None and self._end <= start_time + duration:
+                    outpoint = int(self._end - start_time)
+                    done = True
+
+                self.append_segment(writer, segment_file, inpoint, outpoint, offset)
+                offset += (outpoint if outpoint is not None else duration) - inpoint
+                if done:
+                    break
+
+            if include_newest:
+                done = True
+
+        writer.stdin.close()
+        writer.wait()
+        self._logger.debug(f"Incremental recording finished, {offset:.1f}s recorded")
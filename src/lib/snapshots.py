@@ -0,0 +1,127 @@
+import itertools
+import math
+import time
+
+import cv2
+import numpy as np
+
+from lib.helpers import send_to_post_processor
+
+# Laplacian variance at which an object counts as half as sharp as it can get
+SHARPNESS_REFERENCE = 100.0
+
+
+def sharpness(frame, obj):
+    """Returns the variance of the Laplacian of the luma inside the object box.
+    Blurry objects have few edges and get a low variance"""
+    width, height = frame.frame_width, frame.frame_height
+    try:
+        luma = np.frombuffer(frame.raw_frame, np.uint8, count=width * height).reshape(
+            height, width
+        )
+    except ValueError:
+        return 0.0
+    crop = luma[
+        int(obj.rel_y1 * height) : int(obj.rel_y2 * height),
+        int(obj.rel_x1 * width) : int(obj.rel_x2 * width),
+    ]
+    if crop.size == 0:
+        return 0.0
+    return float(cv2.Laplacian(crop, cv2.CV_64F).var())
+
+
+def object_score(frame, obj):
+    """Scores an object. Confident, large and sharp objects make the best
+    snapshots. The score is stored on the object, since the same object is offered
+    to several selectors"""
+    score = obj.snapshot_score
+    if score is None:
+        obj_sharpness = sharpness(frame, obj)
+        score = (
+            obj.confidence
+            * math.sqrt(obj.rel_width * obj.rel_height)
+            * obj_sharpness
+            / (obj_sharpness + SHARPNESS_REFERENCE)
+        )
+        obj.snapshot_score = score
+    return score
+
+
+def snapshot_score(frame, objects):
+    """Scores a frame by its best object"""
+    return max((object_score(frame, obj) for obj in objects), default=0.0)
+
+
+class SnapshotSelector:
+    """Keeps the best scoring frame offered since the last reset, along with the
+    objects it was scored on"""
+
+    def __init__(self):
+        self._best = None  # (score, frame, objects)
+
+    def offer(self, frame, objects):
+        if frame is None or not objects:
+            return
+        score = snapshot_score(frame, objects)
+        if self._best is None or score > self._best[0]:
+            self._best = (score, frame, list(objects))
+
+    def reset(self):
+        """Returns the best (frame, objects) and starts over.
+        Returns None if no frame was offered"""
+        best, self._best = self._best, None
+        return best[1:] if best else None
+
+
+class PostProcessorDispatcher:
+    """Sends objects to post processors at most once every interval seconds per
+    post processor and zone. The first object starts an interval, and when it is
+    over all objects in the best scoring frame of the interval are sent.
+    Everything sent by one dispatch is queued as one group, since the queue of a
+    post processor only keeps the latest group of each camera.
+    An interval of 0 sends the objects of every frame"""
+
+    def __init__(self, logger, config, post_processors):
+        self._logger = logger
+        self._config = config
+        self._post_processors = post_processors
+        self._interval = config.object_detection.post_processor_interval
+        self._pending = {}  # (post_processor, zone): [interval end, selector]
+        self._groups = itertools.count()
+
+    def send(self, post_processor, frame, objects, zone=None, group=None):
+        for obj in objects:
+            send_to_post_processor(
+                self._logger,
+                self._config,
+                self._post_processors,
+                post_processor,
+                frame,
+                obj,
+                zone=zone,
+                group=group,
+            )
+
+    def offer(self, post_processor, frame, objects, zone=None):
+        if not self._interval:
+            self.send(post_processor, frame, objects, zone=zone)
+            return
+
+        pending = self._pending.setdefault(
+            (post_processor, zone),
+            [time.monotonic() + self._interval, SnapshotSelector()],
+        )
+        pending[1].offer(frame, objects)
+
+    def dispatch(self):
+        """Sends the best frame of each interval which is over"""
+        now = time.monotonic()
+        group = next(self._groups)
+        for key, (interval_end, selector) in list(self._pending.items()):
+            if interval_end > now:
+                continue
+            del self._pending[key]
+            best = selector.reset()
+            if best:
+                post_processor, zone = key
+                self.send(post_processor, *best, zone=zone, group=group)
@@ -1,17 +1,62 @@
 import logging
 
 import cv2
+import numpy as np
+
+from const import ZONE_RASTER_WIDTH
 from lib.helpers import (
     Filter,
-    calculate_absolute_coords,
+    Filters,
     report_labels,
-    send_to_post_processor,
 )
 from lib.mqtt.binary_sensor import MQTTBinarySensor
 
 
+class ZoneRaster:
+    """Low resolution bitmap of all zones of a camera.
+    Bit n of each pixel is set if the pixel is inside zone n, which makes it possible
+    to assign all objects to all zones with one lookup"""
+
+    def __init__(self, zones, camera_resolution):
+        scale = min(1.0, ZONE_RASTER_WIDTH / camera_resolution[0])
+        self._resolution = (
+            max(1, round(camera_resolution[0] * scale)),
+            max(1, round(camera_resolution[1] * scale)),
+        )
+        self._raster = np.zeros(
+            (self._resolution[1], self._resolution[0]), dtype=np.uint64
+        )
+
+        for zone in zones:
+            zone_bitmap = np.zeros(self._raster.shape, dtype=np.uint8)
+            scaled_coordinates = np.multiply(
+                np.divide(zone.coordinates, camera_resolution), self._resolution
+            ).astype("int32")
+            cv2.fillPoly(zone_bitmap, pts=[scaled_coordinates], color=1)
+            self._raster[zone_bitmap == 1] |= zone.bit
+
+    def lookup(self, detections):
+        """Returns a bitmask for each detection with the zones it is in.
+        The bottom center of the bounding box decides which zones an object is in"""
+        boxes = detections.boxes
+        x = ((boxes[:, 0] + boxes[:, 2]) / 2 * self._resolution[0]).astype(int)
+        y = (boxes[:, 3] * self._resolution[1]).astype(int)
+        return self._raster[
+            np.clip(y, 0, self._resolution[1] - 1),
+            np.clip(x, 0, self._resolution[0] - 1),
+        ]
+
+
 class Zone:
-    def __init__(self, zone, camera_resolution, config, mqtt_queue, post_processors):
+    def __init__(
+        self,
+        zone,
+        index,
+        camera_resolution,
+        config,
+        mqtt_queue,
+        post_processor_dispatcher,
+    ):
         self._logger = logging.getLogger(__name__ + "." + config.camera.name_slug)
         if getattr(config.camera.logging, "level", None):
             self._logger.setLevel(config.camera.logging.level)
@@ -20,19 +65,23 @@ class Zone:
         self._camera_resolution = camera_resolution
         self._config = config
         self._mqtt_queue = mqtt_queue
-        self._post_processors = post_processors
+        self._post_processor_dispatcher = post_processor_dispatcher
 
         self._name = zone["name"]
+        self._bit = np.uint64(1 << index)
         self._objects_in_zone = []
         self._labels_in_zone = []
         self._reported_label_count = {}
-        self._object_filters = {}
         self._trigger_recorder = False
         zone_labels = (
             zone["labels"] if zone["labels"] else config.object_detection.labels
         )
-        for object_filter in zone_labels:
-            self._object_filters[object_filter.label] = Filter(object_filter)
+        self._object_filters = Filters(
+            {
+                object_filter.label: Filter(object_filter)
+                for object_filter in zone_labels
+            }
+        )
 
         self._mqtt_devices = {}
         if self._mqtt_queue:
@@ -44,39 +93,36 @@ class Zone:
                     config, mqtt_queue, f"{zone['name']} {label.label}"
                 )
 
-    def filter_zone(self, frame):
+    def filter_zone(self, frame, zone_membership):
+        """Filters objects in zone. zone_membership is a bitmask for each object,
+        as returned by ZoneRaster.lookup"""
         objects_in_zone = []
         labels_in_zone = []
         self._trigger_recorder = False
-        for obj in frame.objects:
-            if self._object_filters.get(obj.label) and self._object_filters[
-                obj.label
-            ].filter_object(obj):
-                x1, _, x2, y2 = calculate_absolute_coords(
-                    (obj.rel_x1, obj.rel_y1, obj.rel_x2, obj.rel_y2,),
-                    self._camera_resolution,
-                )
-                middle = ((x2 - x1) / 2) + x1
-                if cv2.pointPolygonTest(self.coordinates, (middle, y2), False) >= 0:
-                    obj.relevant = True
-                    objects_in_zone.append(obj)
-
-                    if obj.label not in labels_in_zone:
-                        labels_in_zone.append(obj.label)
-
-                    if self._object_filters[obj.label].triggers_recording:
-                        self._trigger_recorder = True
-
-                    # Send detection to configured post processors
-                    if self._object_filters[obj.label].post_processor:
-                        send_to_post_processor(
-                            self._logger,
-                            self._config,
-                            self._post_processors,
-                            self._object_filters[obj.label].post_processor,
-                            frame,
-                            obj,
-                        )
+        passed = self._object_filters.filter_detections(frame.objects) & (
+            (zone_membership & self.bit) != 0
+        )
+        frame.objects.relevant[passed] = True
+        post_processor_objects = {}
+        for obj in frame.objects.select(passed):
+            objects_in_zone.append(obj)
+
+            if obj.label not in labels_in_zone:
+                labels_in_zone.append(obj.label)
+
+            if self._object_filters[obj.label].triggers_recording:
+                self._trigger_recorder = True
+
+            if self._object_filters[obj.label].post_processor:
+                post_processor_objects.setdefault(
+                    self._object_filters[obj.label].post_processor, []
+                ).append(obj)
+
+        # Send detections to configured post processors
+        for post_processor, objects in post_processor_objects.items():
+            self._post_processor_dispatcher.offer(
+                post_processor, frame, objects, zone=self
+            )
 
         self.objects_in_zone = objects_in_zone
         self.labels_in_zone = labels_in_zone
@@ -89,6 +135,10 @@ class Zone:
     def coordinates(self):
         return self._coordinates
 
+    @property
+    def bit(self):
+        return self._bit
+
     @property
     def objects_in_zone(self):
         return self._objects_in_zone
@@ -1,13 +1,14 @@
 import logging
 import signal
-from queue import Queue
 from threading import Thread
 
 from const import LOG_LEVELS
 from lib.cleanup import Cleanup
 from lib.config import CONFIG, NVRConfig, ViseronConfig
 from lib.detector import Detector
-from lib.mqtt import MQTT
+from lib.frame_memory import frame_memory
+from lib.mailbox import Mailbox
+from lib.mqtt import MQTT, MQTTPublishQueue
 from lib.nvr import FFMPEGNVR
 from lib.post_processors import PostProcessor
 from viseron_exceptions import FFprobeError
@@ -24,16 +25,17 @@ class Viseron:
         LOGGER.info("Initializing...")
 
         schedule_cleanup(config)
+        frame_memory(config.frame_memory_budget)
 
         mqtt_queue = None
         mqtt = None
         if config.mqtt:
-            mqtt_queue = Queue(maxsize=100)
-            mqtt = MQTT(config)
-            mqtt_publisher = Thread(target=mqtt.publisher, args=(mqtt_queue,))
+            mqtt_queue = MQTTPublishQueue()
+            mqtt = MQTT(config, mqtt_queue)
+            mqtt_publisher = Thread(target=mqtt.publisher)
             mqtt_publisher.daemon = True
 
-        detector_queue = Queue(maxsize=2)
+        detector_queue = Mailbox(2, name="object_detection input", warn=True)
         detector = Detector(config.object_detection)
         detector_thread = Thread(
             target=detector.object_detection, args=(detector_queue,)
@@ -129,8 +131,6 @@ def schedule_cleanup(config):
     LOGGER.debug("Starting cleanup scheduler")
     cleanup = Cleanup(config)
     cleanup.start()
-    LOGGER.debug("Running initial cleanup")
-    cleanup.cleanup()
 
 
 def log_settings(config):